@@ -0,0 +1,117 @@
+# backups.py
+"""
+Online backups of the live database.
+
+The backup is copied with SQLite's backup API a few pages at a time, from its own connection
+and thread, with a short pause after every step, so neither the event loop nor the database
+writer has to wait for it. The copy is a consistent snapshot of the moment it started:
+its connection keeps one read transaction open for the whole backup, which WAL mode lets the
+writer work around.
+"""
+import asyncio
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import database
+
+# Pages copied per step, and the pause after each step that lets other connections through
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.005
+
+# Where backups go, how many of them are kept and whether they are gzipped. See configure_backups().
+backup_dir = "backups"
+backup_keep = 7
+backup_compress = False
+
+# One backup at a time, e.g. the scheduled one and !backup
+_backup_lock = threading.Lock()
+
+
+def configure_backups(directory: str, keep: int, compress: bool):
+    global backup_dir, backup_keep, backup_compress
+    backup_dir = directory
+    backup_keep = max(1, keep)
+    backup_compress = compress
+
+
+def _backup_prefix() -> str:
+    """Backups are named after the database file, e.g. pets-20240131-120000.db"""
+    return os.path.splitext(os.path.basename(database.DB_FILE))[0] + "-"
+
+
+def _copy_database(destination: str):
+    source = sqlite3.connect(database.DB_FILE, isolation_level=None)
+    target = sqlite3.connect(destination)
+    try:
+        source.execute("PRAGMA busy_timeout = 5000")
+        # Pin one snapshot, otherwise every commit made during the backup would restart it
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master")
+        source.backup(
+            target,
+            pages=BACKUP_PAGES_PER_STEP,
+            progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_PAUSE),
+        )
+        source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+
+
+def _compress(path: str) -> str:
+    compressed = path + ".gz"
+    with open(path, "rb") as raw, gzip.open(compressed, "wb") as packed:
+        shutil.copyfileobj(raw, packed)
+    os.remove(path)
+    return compressed
+
+
+def _remove_old_backups():
+    prefix = _backup_prefix()
+    backups = sorted(
+        name
+        for name in os.listdir(backup_dir)
+        if name.startswith(prefix) and (name.endswith(".db") or name.endswith(".db.gz"))
+    )
+    # The timestamp in the names sorts them oldest first
+    for name in backups[: max(0, len(backups) - backup_keep)]:
+        os.remove(os.path.join(backup_dir, name))
+
+
+def create_backup() -> tuple[str, int] | None:
+    """
+    Backs up the live database into backup_dir, then deletes the oldest backups past backup_keep.
+    Blocks for the whole backup, so run it on its own thread (see create_backup_async()).
+    Returns (path of the backup, its size in bytes), or None if another backup is already running.
+    """
+    if not _backup_lock.acquire(blocking=False):
+        return None
+    try:
+        os.makedirs(backup_dir, exist_ok=True)
+        name = f"{_backup_prefix()}{datetime.datetime.now():%Y%m%d-%H%M%S}.db"
+        path = os.path.join(backup_dir, name)
+        # Written under another name first, so a half-written file is never taken for a backup
+        partial = path + ".partial"
+        try:
+            _copy_database(partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        if backup_compress:
+            path = _compress(path)
+        _remove_old_backups()
+        return path, os.path.getsize(path)
+    finally:
+        _backup_lock.release()
+
+
+async def create_backup_async():
+    # Not on the database executors: a backup must not hold up the bot's own queries
+    return await asyncio.to_thread(create_backup)
@@ -0,0 +1,342 @@
+# benchmarks/run.py
+"""
+Benchmarks the bot's commands against synthetic databases.
+
+Each population size runs in its own process against a fresh copy of a generated
+database (cached in benchmarks/data/, and identical for a given size and seed), so
+results are reproducible and comparable between commits.
+
+Usage (from the repository root):
+    python -m benchmarks.run --sizes 10000 100000 1000000 --output results.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_ITERATIONS = 200
+SEED = 1234
+
+# Share of the synthetic pets that have been neglected long enough to run away
+NEGLECTED_SHARE = 0.01
+
+
+class QueryCounter:
+    """Counts every SQL statement run by the bot's pooled connections."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, statement):
+        with self._lock:
+            self.count += 1
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.display_name = f"user{user_id}"
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, sent, content):
+        self._sent = sent
+        self.content = content
+
+    async def edit(self, *, content=None, embed=None):
+        self._sent.append(content if embed is None else embed)
+
+
+class FakeContext:
+    """Just enough of commands.Context for the handlers: an author and a send that goes nowhere."""
+
+    def __init__(self, user_id):
+        self.author = FakeUser(user_id)
+        self.sent = []
+
+    async def send(self, content=None, *, embed=None):
+        self.sent.append(content if embed is None else embed)
+        return FakeMessage(self.sent, content)
+
+
+class FakeBot:
+    """Stands in for PetBot. It never becomes ready, so the cogs' background loops stay idle."""
+
+    def get_user(self, user_id):
+        return None
+
+    async def fetch_user(self, user_id):
+        return FakeUser(user_id)
+
+    async def wait_until_ready(self):
+        await asyncio.Event().wait()
+
+
+def generate_database(path, population, seed=SEED):
+    """Creates a database with 'population' pets, with stats and inventories spread at random."""
+    import database
+
+    database.DB_FILE = path
+    database.setup_database()
+    database.close_connection()
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    definitions = list(database.get_stat_definitions().values())
+    item_ids = list(database._shop_catalogue)
+
+    con = sqlite3.connect(path)
+    chunk_size = 10_000
+    for start in range(1, population + 1, chunk_size):
+        user_ids = range(start, min(start + chunk_size, population + 1))
+        pets, stats, inventory = [], [], []
+        for user_id in user_ids:
+            born_at = now - rng.randint(0, 365) * 86_400
+            if rng.random() < NEGLECTED_SHARE:
+                last_decay = now - database.DECAY_TICK_SECONDS * rng.randint(100, 1000)
+            else:
+                last_decay = now - int(database.DECAY_TICK_SECONDS * rng.random() * 20)
+            pets.append((user_id, f"Pet {user_id}", born_at, None, last_decay))
+            for definition in definitions:
+                cap = definition["cap"] if definition["cap"] is not None else 5_000
+                last_updated = now - rng.randint(0, 86_400)
+                stats.append((user_id, definition["def_id"], rng.randint(0, cap), last_updated))
+            for item_id in rng.sample(item_ids, rng.randint(0, len(item_ids))):
+                inventory.append((user_id, item_id, rng.randint(1, 20)))
+
+        with con:
+            con.executemany(
+                "INSERT INTO pets (user_id, name, born_at, born_ts, last_prize_ts, last_decay_ts) VALUES (?, ?, '', ?, ?, ?)",
+                pets,
+            )
+            con.executemany(
+                "INSERT INTO pet_stats (owner_id, def_id, stat_value, last_updated_ts) VALUES (?, ?, ?, ?)",
+                stats,
+            )
+            con.executemany(
+                "INSERT INTO inventory (owner_id, item_id, quantity) VALUES (?, ?, ?)",
+                inventory,
+            )
+    con.execute("ANALYZE")
+    con.close()
+
+
+def percentiles(samples):
+    """Summarizes latencies (in seconds) as milliseconds."""
+    samples = sorted(samples)
+    if len(samples) < 2:
+        samples = samples * 2
+    cut_points = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "p50_ms": round(cut_points[49] * 1000, 3),
+        "p95_ms": round(cut_points[94] * 1000, 3),
+        "p99_ms": round(cut_points[98] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+    }
+
+
+async def measure(name, counter, iterations, invoke, results):
+    """Runs 'invoke(i)' sequentially and records its latency and query count."""
+    latencies = []
+    queries_before = counter.count
+    for i in range(iterations):
+        started = time.perf_counter()
+        await invoke(i)
+        latencies.append(time.perf_counter() - started)
+    results[name] = {
+        "iterations": iterations,
+        "queries_per_call": round((counter.count - queries_before) / iterations, 2),
+        **percentiles(latencies),
+    }
+
+
+async def run_benchmarks(population, iterations, seed=SEED):
+    """Invokes every command handler and hot path against the current database."""
+    import database
+    from cogs.admin import AdminCommands
+    from cogs.economy import EconomyCommands
+    from cogs.pet import PetCommands
+
+    bot = FakeBot()
+    pets = PetCommands(bot)
+    economy = EconomyCommands(bot)
+    admin = AdminCommands(bot)
+    # The cogs are never added to a bot, which is what normally binds their commands to them
+    for cog in (pets, economy, admin):
+        for command in cog.get_commands():
+            command.cog = cog
+
+    rng = random.Random(seed)
+    counter = QueryCounter()
+    results = {}
+
+    def user():
+        return rng.randint(1, population)
+
+    def ctx():
+        return FakeContext(user())
+
+    commands = {
+        "status": lambda i: pets.check_status(ctx()),
+        "feed": lambda i: pets.feed_pet(ctx()),
+        "play": lambda i: pets.play_with_pet(ctx()),
+        "clean": lambda i: pets.clean_pet(ctx()),
+        "inventory": lambda i: pets.show_inventory(ctx()),
+        "use": lambda i: pets.use_item(ctx(), "apple"),
+        "name": lambda i: pets.name_pet(ctx(), new_name=f"Bench {i}"),
+        "hatch": lambda i: pets.hatch_pet(FakeContext(population + 1 + i)),
+        "shop": lambda i: economy.show_shop(ctx()),
+        "buy": lambda i: economy.buy_item(ctx(), "apple"),
+        "prize": lambda i: economy.claim_prize(ctx()),
+        "leaderboard": lambda i: economy.show_leaderboard(ctx()),
+        "leaderboard_deep_page": lambda i: economy.show_leaderboard(ctx(), "money", 50),
+        "leaderboard_hunger": lambda i: economy.show_leaderboard(ctx(), "hunger"),
+        "additem": lambda i: admin.add_item(ctx(), FakeUser(user()), "apple", 10_000),
+        "removeitem": lambda i: admin.remove_item(ctx(), FakeUser(user()), "apple", 1),
+    }
+    hot_paths = {
+        "db.fetch_pet": lambda i: database.fetch_pet_async(user()),
+        "db.modify_pet_stat": lambda i: database.modify_pet_stat_async(user(), "money", 1),
+        "db.fetch_leaderboard_page": lambda i: database.fetch_leaderboard_page_async("money"),
+    }
+
+    original_open_connection = database._open_connection
+
+    def open_counted_connection():
+        con = original_open_connection()
+        con.set_trace_callback(counter)
+        return con
+
+    database._open_connection = open_counted_connection
+    try:
+        for name, invoke in {**commands, **hot_paths}.items():
+            await measure(name, counter, iterations, invoke, results)
+
+        # Adding a stat backfills it for the whole population, so it only runs once
+        await measure(
+            "addstat",
+            counter,
+            1,
+            lambda i: admin.add_stat(ctx(), "benchmark", 10, "🏁 Benchmark"),
+            results,
+        )
+        await measure(
+            "delstat", counter, 1, lambda i: admin.delete_stat(ctx(), "benchmark"), results
+        )
+
+        # One full pass of the decay/runaway loop
+        await measure(
+            "stat_decay_loop",
+            counter,
+            1,
+            lambda i: PetCommands.stat_decay_loop.coro(pets),
+            results,
+        )
+    finally:
+        database._open_connection = original_open_connection
+        pets.cog_unload()
+
+    return results
+
+
+def run_population(population, iterations, seed=SEED):
+    """Benchmarks one population size in the current process. Returns the result dict."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    template = os.path.join(DATA_DIR, f"pets-{population}-{seed}.db")
+    if not os.path.exists(template):
+        print(f"Generating a database of {population} pets...", file=sys.stderr)
+        started = time.perf_counter()
+        generate_database(template, population, seed)
+        print(f"Generated in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    # Commands write to the database, so every run starts from a fresh copy
+    working_copy = os.path.join(DATA_DIR, f"run-{population}-{os.getpid()}.db")
+    shutil.copyfile(template, working_copy)
+
+    import database
+
+    database.DB_FILE = working_copy
+    try:
+        database.setup_database()
+        results = asyncio.run(run_benchmarks(population, iterations, seed))
+    finally:
+        database.shutdown_db_threads()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(working_copy + suffix):
+                os.remove(working_copy + suffix)
+
+    return {
+        "population": population,
+        "seed": seed,
+        "sqlite_version": sqlite3.sqlite_version,
+        "python_version": sys.version.split()[0],
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    # Internal: benchmark a single size in this process and print its JSON
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # The bot's own prints go to stderr, stdout only carries the result
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run_population(args.single, args.iterations, args.seed)
+        print(json.dumps(result))
+        return
+
+    # Every size gets a fresh process, the database module's pools and caches are per-process
+    runs = []
+    for population in args.sizes:
+        print(f"Benchmarking {population} pets...", file=sys.stderr)
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.run",
+                "--single",
+                str(population),
+                "--iterations",
+                str(args.iterations),
+                "--seed",
+                str(args.seed),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        sys.stderr.write(output.stderr)
+        runs.append(json.loads(output.stdout))
+
+    report = json.dumps({"runs": runs}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,73 @@
-from typing import Optional
+import time
+from typing import Optional, Union
 import discord
-from discord.ext import commands
-from database import get_db_cursor, fetch_shop_item, get_stat_definition_id
+from discord.ext import commands, tasks
+from backups import create_backup_async
+from metrics import command_latency, command_errors, query_latency, slow_queries
+from database import (
+    fetch_shop_item,
+    fetch_prize_odds,
+    fetch_prize_tiers,
+    get_prize_tier,
+    get_stat_definition,
+    get_stat_definition_id,
+    add_inventory_item_async,
+    remove_inventory_item_async,
+    add_inventory_item_for_pets_async,
+    remove_inventory_item_for_users_async,
+    modify_stats_for_pets_async,
+    upsert_shop_item_async,
+    delete_shop_item_async,
+    set_prize_weight_async,
+    upsert_prize_tier_async,
+    upsert_stat_definition_async,
+    backfill_stat_async,
+    STAT_BACKFILL_CHUNK,
+    count_pets_async,
+    delete_stat_definition_async,
+)
 
 
 class AdminCommands(commands.Cog, name="👮‍♀️ Admin Commands"):
+    # Seconds between progress updates of long-running admin commands
+    PROGRESS_INTERVAL = 2
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        interval = getattr(bot, "backup_interval_hours", 0)
+        if interval > 0 and getattr(bot, "runs_scheduled_backups", True):
+            self.backup_loop.change_interval(hours=interval)
+            self.backup_loop.start()
+
+    def cog_unload(self):
+        self.backup_loop.cancel()
+
+    @tasks.loop(hours=24)
+    async def backup_loop(self):
+        # The first iteration runs right away, the first backup is due after one interval
+        if self.backup_loop.current_loop == 0:
+            return
+        try:
+            result = await create_backup_async()
+        except Exception as e:
+            print(f"Scheduled database backup failed: {e}")
+            return
+        if result is None:
+            print("Skipped the scheduled database backup, another backup is still running.")
+        else:
+            print(f"Backed up the database to {result[0]}.")
+
+    @commands.command(name="backup")
+    @commands.is_owner()
+    async def backup(self, ctx):
+        """(Admin) Backs up the database while the bot keeps running."""
+        message = await ctx.send("⏳ Backing up the database...")
+        result = await create_backup_async()
+        if result is None:
+            await message.edit(content="Error: A backup is already running, try again once it's done.")
+            return
+        path, size = result
+        await message.edit(content=f"✅ Backed up the database to `{path}` ({size / 1_000_000:.1f} MB).")
 
     @commands.command(name="additem")
     @commands.is_owner()
@@ -19,18 +80,15 @@ class AdminCommands(commands.Cog, name="👮‍♀️ Admin Commands"):
         if not item_data:
             await ctx.send(f"Error: Item with ID `{item_id}` not found.")
             return
+        if quantity < 1:
+            await ctx.send("Error: The quantity must be at least 1.")
+            return
 
-        with get_db_cursor() as cur:
-            # We add the item 'quantity' times
-            for _ in range(quantity):
-                cur.execute(
-                    "INSERT INTO inventory (owner_id, item_id) VALUES (?, ?)",
-                    (user.id, item_id),
-                )
+        await add_inventory_item_async(user.id, item_id, quantity)
 
-            await ctx.send(
-                f"✅ Successfully added **{quantity}x {item_data['name']}** to {user.display_name}'s inventory."
-            )
+        await ctx.send(
+            f"✅ Successfully added **{quantity}x {item_data['name']}** to {user.display_name}'s inventory."
+        )
 
     @commands.command(name="removeitem")
     @commands.is_owner()
@@ -44,32 +102,135 @@ class AdminCommands(commands.Cog, name="👮‍♀️ Admin Commands"):
         if not item_data:
             await ctx.send(f"Error: Item with ID `{item_id}` not found.")
             return
+        if quantity < 1:
+            await ctx.send("Error: The quantity must be at least 1.")
+            return
 
-        with get_db_cursor() as cur:
-            # First, check if the user has enough of the item to remove
-            cur.execute(
-                "SELECT entry_id FROM inventory WHERE owner_id = ? AND item_id = ?",
-                (user.id, item_id),
+        removed, owned = await remove_inventory_item_async(user.id, item_id, quantity)
+        if not removed:
+            await ctx.send(
+                f"Error: {user.display_name} only has {owned} of that item, but you tried to remove {quantity}."
             )
-            items_in_inventory = cur.fetchall()
+            return
 
-            if len(items_in_inventory) < quantity:
-                await ctx.send(
-                    f"Error: {user.display_name} only has {len(items_in_inventory)} of that item, but you tried to remove {quantity}."
-                )
-                return
+        await ctx.send(
+            f"✅ Successfully removed **{quantity}x {item_data['name']}** from {user.display_name}'s inventory."
+        )
 
-            # Get the specific database entries to delete
-            entries_to_delete = [
-                item["entry_id"] for item in items_in_inventory[:quantity]
-            ]
+    @staticmethod
+    def _resolve_targets(targets) -> set[int]:
+        """The ids of the (non-bot) users among 'targets' and the members of the roles among them."""
+        members = []
+        for target in targets:
+            members.extend(target.members if isinstance(target, discord.Role) else [target])
+        return {member.id for member in members if not member.bot}
 
-            # Delete the items by their unique entry_id
-            for entry_id in entries_to_delete:
-                cur.execute("DELETE FROM inventory WHERE entry_id = ?", (entry_id,))
+    @commands.command(name="grantitem")
+    @commands.is_owner()
+    @commands.guild_only()
+    async def grant_item(
+        self,
+        ctx,
+        item_id: str,
+        quantity: int,
+        *targets: Union[discord.Role, discord.Member],
+    ):
+        """(Admin) Gives an item to several users at once.
+
+        Targets can be any mix of users and roles, use `@everyone` for the whole server.
+        **Example**:
+        ```
+        !grantitem apple 3 @Event-Winners @Powder
+        ```
+        """
+        item_id = item_id.lower()
+        item_data = fetch_shop_item(item_id)
+        if not item_data:
+            await ctx.send(f"Error: Item with ID `{item_id}` not found.")
+            return
+        if quantity < 1:
+            await ctx.send("Error: The quantity must be at least 1.")
+            return
+        user_ids = self._resolve_targets(targets)
+        if not user_ids:
+            await ctx.send("Error: Nobody matches those targets.")
+            return
+
+        granted = await add_inventory_item_for_pets_async(user_ids, item_id, quantity)
 
         await ctx.send(
-            f"✅ Successfully removed **{quantity}x {item_data['name']}** from {user.display_name}'s inventory."
+            f"✅ Gave **{quantity}x {item_data['name']}** to **{granted}** users."
+            f" {len(user_ids) - granted} of the {len(user_ids)} targeted users have no pet and were skipped."
+        )
+
+    @commands.command(name="revokeitem")
+    @commands.is_owner()
+    @commands.guild_only()
+    async def revoke_item(
+        self,
+        ctx,
+        item_id: str,
+        quantity: int,
+        *targets: Union[discord.Role, discord.Member],
+    ):
+        """(Admin) Removes up to that many copies of an item from several users at once.
+
+        Targets can be any mix of users and roles, use `@everyone` for the whole server.
+        """
+        item_id = item_id.lower()
+        item_data = fetch_shop_item(item_id)
+        if not item_data:
+            await ctx.send(f"Error: Item with ID `{item_id}` not found.")
+            return
+        if quantity < 1:
+            await ctx.send("Error: The quantity must be at least 1.")
+            return
+        user_ids = self._resolve_targets(targets)
+        if not user_ids:
+            await ctx.send("Error: Nobody matches those targets.")
+            return
+
+        users, removed = await remove_inventory_item_for_users_async(user_ids, item_id, quantity)
+
+        await ctx.send(
+            f"✅ Removed **{removed}x {item_data['name']}** from **{users}** of the {len(user_ids)} targeted users."
+        )
+
+    @commands.command(name="grantstat")
+    @commands.is_owner()
+    @commands.guild_only()
+    async def grant_stat(
+        self,
+        ctx,
+        stat_name: str,
+        amount: int,
+        *targets: Union[discord.Role, discord.Member],
+    ):
+        """(Admin) Adds to (or with a negative amount, takes from) a stat of several users' pets at once.
+
+        Targets can be any mix of users and roles, use `@everyone` for the whole server.
+        **Example**:
+        ```
+        !grantstat money 100 @everyone
+        ```
+        """
+        stat_name = stat_name.lower()
+        if not get_stat_definition(stat_name):
+            await ctx.send(f"Error: `{stat_name}` is not a valid stat.")
+            return
+        user_ids = self._resolve_targets(targets)
+        if not user_ids:
+            await ctx.send("Error: Nobody matches those targets.")
+            return
+
+        results = await modify_stats_for_pets_async(user_ids, {stat_name: amount})
+
+        # Stats never go below 0, so pets with less than that lost what they had
+        verb = "Added" if amount >= 0 else "Took up to"
+        preposition = "to" if amount >= 0 else "from"
+        await ctx.send(
+            f"✅ {verb} **{abs(amount)} {stat_name}** {preposition} **{len(results)}** pets."
+            f" {len(user_ids) - len(results)} of the {len(user_ids)} targeted users have no pet and were skipped."
         )
 
     @commands.command(name="addshopitem")
@@ -99,19 +260,15 @@ class AdminCommands(commands.Cog, name="👮‍♀️ Admin Commands"):
             await ctx.send(f"Error: `{effect_stat}` is not a valid stat.")
             return
         
-        with get_db_cursor() as cur:
-            cur.execute(
-                "INSERT OR REPLACE INTO shop VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (
-                    item_id,
-                    name,
-                    price,
-                    description,
-                    effect_stat,
-                    effect_value,
-                    is_visible,
-                ),
-            )
+        await upsert_shop_item_async(
+            item_id,
+            name,
+            price,
+            description,
+            effect_stat,
+            effect_value,
+            is_visible,
+        )
 
         visibility_text = "is visible" if is_visible == 1 else "is a hidden prize"
         await ctx.send(
@@ -123,12 +280,83 @@ class AdminCommands(commands.Cog, name="👮‍♀️ Admin Commands"):
     async def delete_shop_item(self, ctx, item_id: str):
         """(Admin) Deletes an item from the shop."""
         item_id = item_id.lower()
-        with get_db_cursor() as cur:
-            cur.execute("DELETE FROM shop WHERE item_id = ?", (item_id,))
-            if cur.rowcount == 0:
-                await ctx.send(f"Error: Item `{item_id}` not found in the shop.")
-            else:
-                await ctx.send(f"✅ Item `{item_id}` has been removed from the shop.")
+        if not await delete_shop_item_async(item_id):
+            await ctx.send(f"Error: Item `{item_id}` not found in the shop.")
+        else:
+            await ctx.send(f"✅ Item `{item_id}` has been removed from the shop.")
+
+    @commands.command(name="prizeweight")
+    @commands.is_owner()
+    async def set_prize_weight(self, ctx, item_id: str, weight: int, tier: Optional[str] = None):
+        """(Admin) Sets how often an item is won with !prize, compared to the other items of its rarity tier.
+
+        A weight of 0 stops the item from being a prize. Optionally moves it to another tier.
+        **Example**:
+        ```
+        !prizeweight PowPowTreat 2 legendary
+        ```
+        """
+        item_id = item_id.lower()
+        if weight < 0:
+            await ctx.send("Error: The weight can't be negative.")
+            return
+        if tier is not None:
+            tier = tier.lower()
+            if not get_prize_tier(tier):
+                await ctx.send(f"Error: `{tier}` is not a prize tier. Add it with `!prizetier` first.")
+                return
+
+        if not await set_prize_weight_async(item_id, weight, tier):
+            await ctx.send(f"Error: Item with ID `{item_id}` not found.")
+            return
+        item = fetch_shop_item(item_id)
+        await ctx.send(
+            f"✅ `{item_id}` now has a prize weight of **{weight}** in the `{item['prize_tier']}` tier."
+        )
+
+    @commands.command(name="prizetier")
+    @commands.is_owner()
+    async def set_prize_tier(self, ctx, tier: str, weight: int, display_name: Optional[str] = None):
+        """(Admin) Adds a prize rarity tier or sets how often its items are won, compared to the other tiers.
+
+        A weight of 0 stops the tier's items from being prizes.
+        **Example**:
+        ```
+        !prizetier mythic 1 "🟣 Mythic"
+        ```
+        """
+        tier = tier.lower()
+        if weight < 0:
+            await ctx.send("Error: The weight can't be negative.")
+            return
+
+        await upsert_prize_tier_async(tier, weight, display_name)
+        await ctx.send(f"✅ The `{tier}` prize tier now has a weight of **{weight}**.")
+
+    @commands.command(name="droptable")
+    @commands.is_owner()
+    async def show_drop_table(self, ctx):
+        """(Admin) Shows the prize rarity tiers and every item's chance of being won with !prize."""
+        embed = discord.Embed(title="🎁 Prize Drop Table", color=discord.Color.gold())
+        embed.add_field(
+            name="Tiers",
+            value="\n".join(
+                f"{tier['display_name']} (`{tier['tier']}`) - weight {tier['weight']}"
+                for tier in fetch_prize_tiers()
+            ) or "No tiers.",
+            inline=False,
+        )
+        lines = [
+            f"`{item['item_id']}` {item['name']} - {chance:.2%} ({item['prize_tier']}, weight {item['prize_weight']})"
+            for item, chance in fetch_prize_odds()
+        ]
+        embed.add_field(
+            name="Chances",
+            # Embed fields hold at most 1024 characters
+            value="\n".join(lines)[:1024] or "Nothing can be won right now.",
+            inline=False,
+        )
+        await ctx.send(embed=embed)
 
     @commands.command(name="addstat")
     @commands.is_owner()
@@ -144,31 +372,31 @@ class AdminCommands(commands.Cog, name="👮‍♀️ Admin Commands"):
     ):
         """(Admin) Adds/updates a stat's definition. Cooldown is in seconds."""
         stat_name = stat_name.lower()
-        with get_db_cursor() as cur:
-            cur.execute(
-                "INSERT OR REPLACE INTO stat_definitions (stat_name, default_value, cap, cooldown_seconds, decay_amount, display_name) VALUES (?, ?, ?, ?, ?, ?)",
-                (stat_name, default, cap, cooldown, decay, display_name),
-            )
-            # Get the ID of the stat we just created/updated
-            new_stat_id = cur.lastrowid
-
-            cur.execute("SELECT user_id FROM pets")
-            all_users = cur.fetchall()
-            added_count = 0
-            for user in all_users:
-                cur.execute(
-                    "SELECT 1 FROM pet_stats WHERE owner_id = ? AND def_id = ?",
-                    (user["user_id"], new_stat_id),
+        def_id = await upsert_stat_definition_async(
+            stat_name, default, cap, cooldown, decay, display_name
+        )
+
+        # Existing pets get the stat a chunk at a time, so other commands keep running meanwhile
+        total = await count_pets_async()
+        message = await ctx.send(
+            f"✅ Stat definition for `{stat_name}` has been set. Adding it to existing pets..."
+        )
+        added_count, done, after = 0, 0, 0
+        last_report = time.monotonic()
+        while True:
+            added, after = await backfill_stat_async(def_id, default, after)
+            if after is None:
+                break
+            added_count += added
+            done += STAT_BACKFILL_CHUNK
+            if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await message.edit(
+                    content=f"⏳ Adding `{stat_name}` to existing pets... {min(done, total)}/{total}"
                 )
-                if not cur.fetchone():
-                    cur.execute(
-                        "INSERT INTO pet_stats (owner_id, def_id, stat_value) VALUES (?, ?, ?)",
-                        (user["user_id"], new_stat_id, default),
-                    )
-                    added_count += 1
 
-        await ctx.send(
-            f"✅ Stat definition for `{stat_name}` has been set. Added to **{added_count}** existing pets."
+        await message.edit(
+            content=f"✅ Stat definition for `{stat_name}` has been set. Added to **{added_count}** existing pets."
         )
     
     @commands.command(name='delstat')
@@ -176,13 +404,58 @@ class AdminCommands(commands.Cog, name="👮‍♀️ Admin Commands"):
     async def delete_stat(self, ctx, stat_name: str):
         """(Admin) Deletes a stat definition and all instances of it from pets."""
         stat_name = stat_name.lower()
-        with get_db_cursor() as cur:
-            cur.execute("DELETE FROM stat_definitions WHERE stat_name = ?", (stat_name,))
-            cur.execute("DELETE FROM shop WHERE effect_stat = ?", (stat_name,))
-            if cur.rowcount == 0:
-                await ctx.send(f"Error: The stat `{stat_name}` was not found.")
-            else:
-                await ctx.send(f"✅ Deleted the stat `{stat_name}`. All pet instances of this stat have been automatically removed.")
+        if not await delete_stat_definition_async(stat_name):
+            await ctx.send(f"Error: The stat `{stat_name}` was not found.")
+        else:
+            await ctx.send(f"✅ Deleted the stat `{stat_name}`. All pet instances of this stat have been automatically removed.")
+
+    @staticmethod
+    def _format_latencies(histogram, prefix=""):
+        """One line per label, busiest first: call count and bucketed p50/p95."""
+        snapshot = histogram.snapshot()
+        lines = []
+        for label, (counts, total) in sorted(
+            snapshot.items(), key=lambda item: sum(item[1][0]), reverse=True
+        )[:15]:
+            p50 = histogram.quantile(label, 0.5) * 1000
+            p95 = histogram.quantile(label, 0.95) * 1000
+            lines.append(
+                f"`{prefix}{label}` - {sum(counts)}x, p50 ≤ {p50:g}ms, p95 ≤ {p95:g}ms"
+            )
+        return "\n".join(lines) or "Nothing recorded yet."
+
+    @commands.command(name="metrics")
+    @commands.is_owner()
+    async def show_metrics(self, ctx):
+        """(Admin) Shows command and database latencies and the slowest recent queries."""
+        embed = discord.Embed(title="📊 Metrics", color=discord.Color.dark_teal())
+        embed.add_field(
+            name="Commands",
+            value=self._format_latencies(command_latency, prefix="!"),
+            inline=False,
+        )
+        embed.add_field(
+            name="SQL statements",
+            value=self._format_latencies(query_latency),
+            inline=False,
+        )
+
+        errors = command_errors.snapshot()
+        if errors:
+            embed.add_field(
+                name="Errors",
+                value="\n".join(f"`{name}` - {count}x" for name, count in errors.items()),
+                inline=False,
+            )
+
+        if slow_queries:
+            lines = [
+                f"{when:%H:%M:%S} - {seconds * 1000:.0f}ms - `{sql[:80]}`"
+                for when, seconds, sql in list(slow_queries)[-5:]
+            ]
+            embed.add_field(name="Slow queries", value="\n".join(lines), inline=False)
+
+        await ctx.send(embed=embed)
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(AdminCommands(bot))
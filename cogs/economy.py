@@ -2,25 +2,30 @@ from typing import Optional
 import discord
 from discord.ext import commands
 import datetime
-import random
+import time
 from database import (
-    get_db_cursor,
-    fetch_pet,
-    modify_pet_stat,
-    fetch_all_shop_items,
+    fetch_pet_async,
+    fetch_visible_shop_items,
     fetch_shop_item,
+    get_prize_tier,
+    get_shop_catalogue_version,
+    purchase_item_async,
+    grant_random_prize_async,
+    fetch_leaderboard_page_async,
+    get_stat_definition,
 )
+from utils import cooldowns
 
 
 class EconomyCommands(commands.Cog, name="📈 Economy Commands"):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        # The rendered shop embed and the catalogue version it was built from
+        self._shop_embed = None
+        self._shop_embed_version = None
 
-    @commands.command(name="shop")
-    async def show_shop(self, ctx: commands.Context):
-        """Displays the items available for purchase in the shop."""
-        # The query now filters for is_visible = 1
-        shop_items = fetch_all_shop_items()
+    def _build_shop_embed(self) -> discord.Embed:
+        shop_items = fetch_visible_shop_items()
 
         embed = discord.Embed(
             title="Pet Shop",
@@ -28,20 +33,28 @@ class EconomyCommands(commands.Cog, name="📈 Economy Commands"):
             color=discord.Color.gold(),
         )
 
-        visible_items_found = False
         for item in shop_items:
-            if item["is_visible"] == 1:
-                embed.add_field(
-                    name=f"{item['name']} - {item['price']} Coins",
-                    value=f"`{item['item_id']}` - {item['description']}",
-                    inline=False,
-                )
-                visible_items_found = True
-
-        if not visible_items_found:
+            embed.add_field(
+                name=f"{item['name']} - {item['price']} Coins",
+                value=f"`{item['item_id']}` - {item['description']}",
+                inline=False,
+            )
+
+        if not shop_items:
             embed.description = "The shop is currently empty!"
 
-        await ctx.send(embed=embed)
+        return embed
+
+    @commands.command(name="shop")
+    async def show_shop(self, ctx: commands.Context):
+        """Displays the items available for purchase in the shop."""
+        # Only rebuilt after the shop itself changes
+        version = get_shop_catalogue_version()
+        if self._shop_embed is None or self._shop_embed_version != version:
+            self._shop_embed = self._build_shop_embed()
+            self._shop_embed_version = version
+
+        await ctx.send(embed=self._shop_embed)
 
     @commands.command(name="buy")
     async def buy_item(self, ctx, item_id: str):
@@ -55,7 +68,7 @@ class EconomyCommands(commands.Cog, name="📈 Economy Commands"):
 
         user_id = ctx.author.id
 
-        pet = fetch_pet(user_id)
+        pet = await fetch_pet_async(user_id)
         if not pet:
             await ctx.send("You need to hatch a pet first!")
             return
@@ -65,108 +78,101 @@ class EconomyCommands(commands.Cog, name="📈 Economy Commands"):
             )
             return
 
-        modify_pet_stat(user_id, "money", -item["price"])
-        with get_db_cursor() as cur:
-            cur.execute(
-                "INSERT INTO inventory (owner_id, item_id) VALUES (?, ?)",
-                (user_id, item_id),
-            )
+        # The balance is checked again as the coins are taken, another !buy may have spent them meanwhile
+        if not await purchase_item_async(user_id, item_id, item["price"]):
+            await ctx.send(f"You don't have enough money! You need {item['price']} coins.")
+            return
 
         await ctx.send(f"You bought a {item['name']}! It's in your inventory.")
 
+    @staticmethod
+    def _prize_cooldown_message(time_remaining: float) -> str:
+        hours, remainder = divmod(int(time_remaining), 3600)
+        minutes, _ = divmod(remainder, 60)
+        return f"You've already claimed your prize. Please wait **{hours}h {minutes}m**."
+
     @commands.command(name="prize")
     async def claim_prize(self, ctx: commands.Context):
         """Claims a daily prize of a random item."""
         user_id = ctx.author.id
         cooldown = datetime.timedelta(hours=24)
 
-        pet = fetch_pet(user_id)
+        # Repeated claims are turned down from the cooldown index, without loading the pet
+        time_remaining = cooldowns.remaining(user_id, "prize")
+        if time_remaining > 0:
+            await ctx.send(self._prize_cooldown_message(time_remaining))
+            return
+
+        pet = await fetch_pet_async(user_id)
 
         if not pet:
             await ctx.send("You need to `!hatch` a pet before claiming a prize.")
             return
 
-        time_since_claim = datetime.datetime.now() - pet.last_prize
+        ready_at = pet.last_prize + cooldown
+        cooldowns.record(user_id, "prize", ready_at.timestamp())
+        time_remaining = (ready_at - datetime.datetime.now()).total_seconds()
 
-        if time_since_claim < cooldown:
-            time_remaining = cooldown - time_since_claim
-            hours, remainder = divmod(int(time_remaining.total_seconds()), 3600)
-            minutes, _ = divmod(remainder, 60)
-            await ctx.send(
-                f"You've already claimed your prize. Please wait **{hours}h {minutes}m**."
-            )
+        if time_remaining > 0:
+            await ctx.send(self._prize_cooldown_message(time_remaining))
             return
 
-        with get_db_cursor() as cur:
-            # If cooldown is over, grant a random item prize
-            cur.execute("SELECT item_id FROM shop")
-            all_possible_items = cur.fetchall()
-
-            if not all_possible_items:
-                await ctx.send(
-                    "There are no items available to win as prizes right now!"
-                )
-                return
-
-            won_item_id = random.choice(all_possible_items)["item_id"]
-            item_details = fetch_shop_item(won_item_id)
-
-            # Add item to inventory and update timestamp
-            cur.execute(
-                "INSERT INTO inventory (owner_id, item_id) VALUES (?, ?)",
-                (ctx.author.id, won_item_id),
-            )
-            cur.execute(
-                "UPDATE pets SET last_prize = ? WHERE user_id = ?",
-                (datetime.datetime.now().isoformat(), ctx.author.id),
-            )
+        # If cooldown is over, grant a random item prize
+        item_details = await grant_random_prize_async(user_id)
+        if not item_details:
+            await ctx.send("There are no items available to win as prizes right now!")
+            return
 
+        cooldowns.record(user_id, "prize", time.time() + cooldown.total_seconds())
+        tier = get_prize_tier(item_details["prize_tier"])
+        rarity = f" ({tier['display_name']})" if tier else ""
         await ctx.send(
-            f"You claimed your daily prize and received a {item_details['name']}! It's now in your inventory."
+            f"You claimed your daily prize and received a {item_details['name']}{rarity}! It's now in your inventory."
         )
 
     @commands.command(name="leaderboard", aliases=["lb"])
-    async def show_leaderboard(self, ctx: commands.Context):
-        """Shows the top 10 richest pet owners."""
-
-        with get_db_cursor() as cur:
-            # The SQL query to get the top 10 users, sorted by money
-            cur.execute("""
-                SELECT ps.owner_id
-                FROM pet_stats ps
-                JOIN stat_definitions sd ON ps.def_id = sd.def_id
-                WHERE sd.stat_name = 'money'
-                ORDER BY ps.stat_value DESC LIMIT 10
-            """)
-            top_users = cur.fetchall()
-
-        if not top_users:
+    async def show_leaderboard(
+        self, ctx: commands.Context, stat_name: str = "money", page: int = 1
+    ):
+        """Shows the top 10 richest pet owners, or the top pets for any stat.
+
+        **Example**:
+        ```
+        !lb happiness 2
+        ```
+        """
+        stat_name = stat_name.lower()
+        stat_definition = get_stat_definition(stat_name)
+        if not stat_definition:
+            await ctx.send(f"Error: `{stat_name}` is not a valid stat.")
+            return
+        page = max(1, page)
+
+        entries = await fetch_leaderboard_page_async(stat_name, page)
+
+        if not entries:
             await ctx.send("There's no one on the leaderboard yet!")
             return
 
-        embed = discord.Embed(
-            title="💰 Top 10 Richest Pets", color=discord.Color.green()
-        )
+        if stat_name == "money":
+            title = "💰 Top 10 Richest Pets"
+        else:
+            title = f"{stat_definition['display_name']} Leaderboard"
+        if page > 1:
+            title += f" (page {page})"
+        embed = discord.Embed(title=title, color=discord.Color.green())
 
+        unit = " Coins" if stat_name == "money" else ""
         description = ""
-        for rank, user_data in enumerate(top_users, start=1):
-            # We need to fetch the Discord user object to get their current name
-            # This is an API call, so it can be slow if the leaderboard is long
-            userId = user_data["owner_id"]
-            user = self.bot.get_user(userId)
+        for entry in entries:
+            # Only the cached Discord user is used, fetching it would be an API call per row
+            user = self.bot.get_user(entry["owner_id"])
             if user:
                 user_display_name = user.display_name
             else:
                 user_display_name = "Unknown User"  # If the user has left the server
 
-            pet = fetch_pet(userId)
-            if not pet:
-                print(f"Could not find pet from owner {user_data['owner_id']}")
-                continue
-
-            description += (
-                f"**{rank}.** {user_display_name}'s *{pet.name}* - {pet.money} Coins\n"
-            )
+            description += f"**{entry['rank']}.** {user_display_name}'s *{entry['name']}* - {entry['stat_value']}{unit}\n"
 
         embed.description = description
         await ctx.send(embed=embed)
@@ -1,22 +1,36 @@
+import asyncio
 import random
-from typing import Counter
+import time
 import discord
 from discord.ext import commands, tasks
 import datetime
 from database import (
     fetch_shop_item,
-    get_db_cursor,
-    fetch_pet,
-    get_stat_definition_id,
-    modify_pet_stat,
+    fetch_pet_async,
+    get_stat_definition,
+    modify_pet_stats_async,
+    create_pet_async,
+    rename_pet_async,
+    fetch_inventory_async,
+    consume_inventory_item_async,
+    remove_runaway_pets_async,
+    claim_due_notifications_async,
+    complete_notifications_async,
 )
-from utils import Pet
+from utils import Pet, cooldowns
 
 
 class PetCommands(commands.Cog, name="🐶 Pet Commands"):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.stat_decay_loop.start()
+        # With several sharded processes only one of them removes runaway pets
+        if getattr(bot, "runs_background_jobs", True):
+            self.stat_decay_loop.start()
+        self.notification_loop.start()
+
+    def cog_unload(self):
+        self.stat_decay_loop.cancel()
+        self.notification_loop.cancel()
 
     def _get_pet_mood(self, pet: Pet):
         """Determines a pet's mood based on its stats."""
@@ -36,150 +50,134 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
 
         return "Joyful 😊"
 
-    def _care_for_pet(self, user_id: str, stat_name: str, restore_amount: int):
-        """Performs a care action on your pet to restore a specific stat."""
+    async def _care_for_pet(
+        self,
+        user_id: str,
+        stat_name: str,
+        restore_amount: int,
+        extra_deltas: dict[str, int] | None = None,
+    ):
+        """Performs a care action on your pet to restore a specific stat.
+
+        Any extra_deltas (e.g. coins earned) are applied in the same transaction.
+        """
         stat_name = stat_name.lower()
 
-        # 1. Fetch the rules for this action from the database
-        with get_db_cursor() as cur:
-            cur.execute(
-                "SELECT * FROM stat_definitions WHERE stat_name = ?", (stat_name,)
-            )
-            stat_definition = cur.fetchone()
+        # 1. Look up the rules for this action in the stat registry
+        stat_definition = get_stat_definition(stat_name)
 
         if not stat_definition:
             return False, f"`{stat_name}` is not a valid target for a care action."
 
-        # 2. Fetch the pet's current data for this stat
-        pet = fetch_pet(user_id)
-        if not pet or stat_name not in pet._stats:
+        # 2. Spam is turned down from the cooldown index, without loading the pet
+        cooldown = stat_definition["cooldown_seconds"] or 0
+        time_remaining = cooldowns.remaining(user_id, stat_name)
+        if time_remaining > 0:
+            return False, self._cooldown_message(time_remaining)
+
+        # 3. Fetch the pet's current data for this stat
+        pet = await fetch_pet_async(user_id)
+        if not pet or not pet.has_stat(stat_name):
             return False, str("You don't have a pet to care for!")
 
-        # 3. Perform the cooldown check
-        stat_data = pet.get_stat(stat_name)
-        cooldown = datetime.timedelta(seconds=stat_definition["cooldown_seconds"] or 0)
-        last_cared_str = stat_data["last_updated"]
-
-        if last_cared_str:
-            last_cared_time = datetime.datetime.fromisoformat(last_cared_str)
-            if datetime.datetime.now() - last_cared_time < cooldown:
-                time_remaining = cooldown - (datetime.datetime.now() - last_cared_time)
-                minutes, seconds = divmod(int(time_remaining.total_seconds()), 60)
-                return (
-                    False,
-                    f"You must wait **{minutes}m {seconds}s** before doing that again.",
-                )
+        # 4. Perform the cooldown check against the database, and remember the result
+        last_cared_time = pet.get_stat_last_updated(stat_name)
+
+        if last_cared_time is not None:
+            ready_at = last_cared_time + cooldown
+            cooldowns.record(user_id, stat_name, ready_at)
+            time_remaining = ready_at - time.time()
+            if time_remaining > 0:
+                return False, self._cooldown_message(time_remaining)
+
+        # 5. If cooldown is over, perform the action
+        deltas = {stat_name: restore_amount}
+        for extra_stat, amount in {"willpower": 1, **(extra_deltas or {})}.items():
+            deltas[extra_stat] = deltas.get(extra_stat, 0) + amount
+        new_values = await modify_pet_stats_async(user_id, deltas)
+        if not new_values:
+            return False, str("You don't have a pet to care for!")
 
-        # 4. If cooldown is over, perform the action
-        new_value = modify_pet_stat(user_id, stat_name, restore_amount)
-        modify_pet_stat(user_id, "willpower", 1)
+        cooldowns.record(user_id, stat_name, time.time() + cooldown)
+        return True, new_values[stat_name]
 
-        return True, new_value
+    @staticmethod
+    def _cooldown_message(time_remaining: float) -> str:
+        minutes, seconds = divmod(int(time_remaining), 60)
+        return f"You must wait **{minutes}m {seconds}s** before doing that again."
 
-    @tasks.loop(minutes=45)
+    # Decay itself is applied lazily whenever a pet is read or written,
+    # this loop only has to find and remove the pets that ran away in the meantime.
+    @tasks.loop(minutes=15)
     async def stat_decay_loop(self):
-        with get_db_cursor() as cur:
-            # Step 1: Regular stat decay for all pets
-            # Get all the rules for stats that are supposed to decay
-            cur.execute(
-                "SELECT def_id, decay_amount FROM stat_definitions WHERE decay_amount > 0"
-            )
-            decay_rules = cur.fetchall()
-
-            for rule in decay_rules:
-                cur.execute(
-                    "UPDATE pet_stats SET stat_value = MAX(0, stat_value - ?) WHERE def_id = ?",
-                    (rule["decay_amount"], rule["def_id"]),
-                )
+        # The pets are deleted and their owners' DMs queued in one committed transaction,
+        # the notification loop delivers the DMs afterwards.
+        pets_to_remove = await remove_runaway_pets_async()
 
-            willpower_id = get_stat_definition_id("willpower")
+        if pets_to_remove is None:
+            print(
+                "Failed to find a valid def_if for the willpower stat. Aborting decay loop..."
+            )
+            return
 
-            if not willpower_id:
+        print(f"Runaway pet check has run. {len(pets_to_remove)} pets ran away.")
+
+    # How many DMs are sent at once. discord.py waits out rate limits on its own,
+    # this only keeps a mass-neglect event from flooding its HTTP queue.
+    NOTIFICATION_CONCURRENCY = 5
+
+    async def _deliver_notification(self, notification, semaphore: asyncio.Semaphore):
+        """Sends one queued DM. Returns True if it is done with, False to retry it later."""
+        user_id = notification["user_id"]
+        async with semaphore:
+            try:
+                user = await self.bot.fetch_user(user_id)
+                await user.send(notification["message"])
+                return True
+            except (discord.Forbidden, discord.NotFound):
                 print(
-                    "Failed to find a valid def_if for the willpower stat. Aborting decay loop..."
+                    f"Failed to send DM to user {user_id}. They might have DMs disabled."
                 )
-                return
-
-            # Step 2: Decrease Willpower for neglected pets (stats at 0)
-            cur.execute(
-                """
-                UPDATE pet_stats
-                SET stat_value = MAX(0, stat_value - 5)
-                WHERE def_id = ? AND owner_id IN (
-                    SELECT owner_id
-                    FROM pet_stats
-                    WHERE stat_value <= 0
-                    AND def_id IN (
-                        SELECT def_id FROM stat_definitions WHERE decay_amount > 0 AND decay_amount IS NOT NULL
-                    )
+                return True
+            except discord.HTTPException as e:
+                print(
+                    f"Failed to send DM to user {user_id} (attempt {notification['attempts']}): {e}"
                 )
-            """,
-                (willpower_id,),
+                return False
+
+    @tasks.loop(seconds=30)
+    async def notification_loop(self):
+        semaphore = asyncio.Semaphore(self.NOTIFICATION_CONCURRENCY)
+        while notifications := await claim_due_notifications_async():
+            delivered = await asyncio.gather(
+                *(self._deliver_notification(n, semaphore) for n in notifications)
             )
-
-            # Step 3: Find any pets whose willpower has hit 0
-            cur.execute(
-                """
-                SELECT ps.owner_id, p.name 
-                FROM pet_stats ps 
-                JOIN pets p ON ps.owner_id = p.user_id 
-                WHERE ps.def_id = ? AND ps.stat_value <= 0
-            """,
-                (willpower_id,),
+            await complete_notifications_async(
+                [n["notification_id"] for n, done in zip(notifications, delivered) if done]
             )
-            pets_to_remove = cur.fetchall()
-
-            for pet in pets_to_remove:
-                user_id = pet["user_id"]
-                pet_name = pet["name"]
-
-                # Step 4: Delete the pet and its inventory
-                cur.execute("DELETE FROM pets WHERE user_id = ?", (user_id,))
-                cur.execute("DELETE FROM pet_stats WHERE owner_id = ?", (user_id,))
-                cur.execute("DELETE FROM inventory WHERE owner_id = ?", (user_id,))
-
-                # Step 5: Try to send a DM to the user
-                try:
-                    user = await self.bot.fetch_user(user_id)
-                    await user.send(
-                        f"You neglected your pet, **{pet_name}**, for too long. It has lost all its Willpower and run away. 😥"
-                    )
-                except discord.HTTPException:
-                    print(
-                        f"Failed to send DM to user {user_id}. They might have DMs disabled."
-                    )
-
-        print("Database stat decay and neglect loop has run.")
+            if not all(delivered):
+                # Something is wrong on Discord's side, the failed ones come back after a delay
+                break
 
     @stat_decay_loop.before_loop
     async def before_stat_decay_loop(self):
         await self.bot.wait_until_ready()
 
+    @notification_loop.before_loop
+    async def before_notification_loop(self):
+        await self.bot.wait_until_ready()
+
     @commands.command(name="hatch")
     async def hatch_pet(self, ctx):
         """Hatches a new pet."""
         user_id = ctx.author.id
-        with get_db_cursor() as cur:
-            cur.execute("SELECT user_id FROM pets WHERE user_id = ?", (user_id,))
-            if cur.fetchone():
-                await ctx.send("You already have a pet!")
-            else:
-                cur.execute(
-                    "INSERT INTO pets (user_id, name, born_at) VALUES (?, ?, ?)",
-                    (user_id, "Pet", datetime.datetime.now().isoformat()),
-                )
-
-                cur.execute("SELECT def_id, default_value FROM stat_definitions")
-                default_stats = cur.fetchall()
-
-                for stat in default_stats:
-                    cur.execute(
-                        "INSERT INTO pet_stats (owner_id, def_id, stat_value) VALUES (?, ?, ?)",
-                        (user_id, stat["def_id"], stat["default_value"]),
-                    )
-                await ctx.send(
-                    f"Congratulations, {ctx.author.display_name}! You've hatched a new pet! 🎉"
-                )
+        # create_pet drops the cooldowns left over from a pet that ran away, on every worker of a cluster
+        if not await create_pet_async(user_id):
+            await ctx.send("You already have a pet!")
+        else:
+            await ctx.send(
+                f"Congratulations, {ctx.author.display_name}! You've hatched a new pet! 🎉"
+            )
 
     @commands.command(name="name")
     async def name_pet(self, ctx, *, new_name: str):
@@ -190,20 +188,15 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
             await ctx.send("The name must be between 1 and 25 characters long.")
             return
 
-        with get_db_cursor() as cur:
-            cur.execute(
-                "UPDATE pets SET name = ? WHERE user_id = ?", (new_name, user_id)
-            )
-
-            if cur.rowcount == 0:
-                await ctx.send("You don't have a pet to name! Use `!hatch` first.")
-            else:
-                await ctx.send(f"You've named your pet **{new_name}**! 🎉")
+        if not await rename_pet_async(user_id, new_name):
+            await ctx.send("You don't have a pet to name! Use `!hatch` first.")
+        else:
+            await ctx.send(f"You've named your pet **{new_name}**! 🎉")
 
     @commands.command(name="status")
     async def check_status(self, ctx):
         """Checks your pet's current status."""
-        pet = fetch_pet(ctx.author.id)
+        pet = await fetch_pet_async(ctx.author.id)
         if not pet:
             await ctx.send("You don't have a pet yet! Type `!hatch` to get one.")
             return
@@ -220,10 +213,9 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
 
         embed.add_field(name="🎭 Mood", value=mood, inline=True)
 
-        for _, stat_data in pet._stats.items():
-            display_name = stat_data["display_name"]
-            value = stat_data["stat_value"]
-            cap = stat_data["cap"]
+        for stat_definition, value in pet.stats():
+            display_name = stat_definition["display_name"]
+            cap = stat_definition["cap"]
 
             display_value = f"{value} / {cap}" if cap is not None else str(value)
             embed.add_field(name=display_name, value=display_value, inline=True)
@@ -236,7 +228,7 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
     async def feed_pet(self, ctx):
         """Feeds your pet to restore hunger."""
         user_id = ctx.author.id
-        success, value = self._care_for_pet(user_id, "hunger", 15)
+        success, value = await self._care_for_pet(user_id, "hunger", 15)
 
         if not success:
             await ctx.send(value)
@@ -248,15 +240,15 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
     async def play_with_pet(self, ctx):
         """Plays with your pet to restore happiness and earn coins."""
         user_id = ctx.author.id
-        success, value = self._care_for_pet(user_id, "happiness", 20)
+        money_earned = random.randint(5, 15)
+        success, value = await self._care_for_pet(
+            user_id, "happiness", 20, {"money": money_earned}
+        )
 
         if not success:
             await ctx.send(value)
             return
 
-        money_earned = random.randint(5, 15)
-        modify_pet_stat(user_id, "money", money_earned)
-
         await ctx.send(
             f"You played with your pet! ❤️ Its happiness is now {value}/100. You also earned {money_earned} coins! 💰"
         )
@@ -265,7 +257,7 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
     async def clean_pet(self, ctx):
         """Cleans your pet to restore cleanliness."""
         user_id = ctx.author.id
-        success, value = self._care_for_pet(user_id, "cleanliness", 100)
+        success, value = await self._care_for_pet(user_id, "cleanliness", 100)
 
         if not success:
             await ctx.send(value)
@@ -277,33 +269,27 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
     async def show_inventory(self, ctx):
         """Displays the items in your inventory."""
         user_id = ctx.author.id
-        with get_db_cursor() as cur:
-            cur.execute("SELECT item_id FROM inventory WHERE owner_id = ?", (user_id,))
-
-            items_in_db = cur.fetchall()
-
-            if not items_in_db:
-                await ctx.send("Your inventory is empty. Buy items from the `!shop`!")
-                return
+        items_in_db = await fetch_inventory_async(user_id)
 
-            item_ids = [item[0] for item in items_in_db]
-            item_counts = Counter(item_ids)
+        if not items_in_db:
+            await ctx.send("Your inventory is empty. Buy items from the `!shop`!")
+            return
 
-            embed = discord.Embed(
-                title=f"{ctx.author.display_name}'s Inventory",
-                color=discord.Color.orange(),
-            )
+        embed = discord.Embed(
+            title=f"{ctx.author.display_name}'s Inventory",
+            color=discord.Color.orange(),
+        )
 
-            description = ""
-            for item_id, count in item_counts.items():
-                item_data = fetch_shop_item(item_id)
-                if not item_data:
-                    await ctx.send(f"Error: Item with ID `{item_id}` not found.")
-                    return
-                description += f"{item_data['name']} **x{count}**\n"
+        description = ""
+        for item_id, count in items_in_db:
+            item_data = fetch_shop_item(item_id)
+            if not item_data:
+                await ctx.send(f"Error: Item with ID `{item_id}` not found.")
+                return
+            description += f"{item_data['name']} **x{count}**\n"
 
-            embed.description = description
-            await ctx.send(embed=embed)
+        embed.description = description
+        await ctx.send(embed=embed)
 
     @commands.command(name="use")
     async def use_item(self, ctx, item_id: str):
@@ -316,19 +302,15 @@ class PetCommands(commands.Cog, name="🐶 Pet Commands"):
 
         user_id = ctx.author.id
 
-        new_stat_value = modify_pet_stat(
-            user_id, item["effect_stat"], item["effect_value"]
-        )
-        modify_pet_stat(user_id, "willpower", 2)
-
-        # Remove item from inventory
-        with get_db_cursor() as cur:
-            cur.execute("""
-                DELETE FROM inventory
-                WHERE entry_id = (SELECT entry_id FROM inventory WHERE owner_id = ? AND item_id = ? LIMIT 1)
-                """,
-                (user_id, item_id),
-            )
+        # Remove item from inventory, making sure the user actually had one
+        if not await consume_inventory_item_async(user_id, item_id):
+            await ctx.send(f"You don't have any {item['name']} in your inventory.")
+            return
+
+        deltas = {item["effect_stat"]: item["effect_value"]}
+        deltas["willpower"] = deltas.get("willpower", 0) + 2
+        new_values = await modify_pet_stats_async(user_id, deltas)
+        new_stat_value = new_values[item["effect_stat"]] if new_values else None
 
         await ctx.send(
             f"You used a {item['name']}! Your pet's {item['effect_stat']} is now {new_stat_value}."
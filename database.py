@@ -1,12 +1,99 @@
 # database.py
+import asyncio
+import collections
 import datetime
+import functools
+import json
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
-from utils import Pet
+from metrics import TimedCursor
+from utils import AliasSampler, Pet, StatLayout, cooldowns
 
 DB_FILE = "pets.db"
 
+# Every blocking SQLite call made from a coroutine goes through one of these executors,
+# so a slow write never stalls the discord.py event loop (and its heartbeat).
+# SQLite only allows one writer at a time, so writes are serialized on a single thread,
+# while WAL mode lets the reader threads keep serving snapshots during a long write.
+DB_READER_THREADS = 4
+_db_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pawder-db-write")
+_db_read_executor = ThreadPoolExecutor(
+    max_workers=DB_READER_THREADS, thread_name_prefix="pawder-db-read"
+)
+
+# How many prepared statements each connection keeps compiled (sqlite3's LRU cache)
+DB_STATEMENT_CACHE_SIZE = 256
+
+# Each thread owns one long-lived connection, so the pool is one connection per executor thread
+_connections = threading.local()
+
+# Stats decay lazily: rather than a sweep rewriting every pet on a timer, each pet remembers
+# when decay was last applied to it (pets.last_decay_ts) and the missed ticks are worked out
+# whenever it is read or written.
+DECAY_TICK_SECONDS = 45 * 60
+# Willpower lost on every tick during which one of the decaying stats is at 0
+NEGLECT_WILLPOWER_PENALTY = 5
+
+# In-memory copy of the stat_definitions table as (by stat_name, by def_id) dicts, plus the
+# StatLayout fetched pets store their values in. It is swapped as a whole on refresh,
+# so readers on any thread never see a half-built registry.
+_stat_registry: tuple[dict[str, dict], dict[int, dict], StatLayout] = ({}, {}, StatLayout(()))
+_stat_registry_version = 0
+
+# DMs are queued in the notification_outbox table in the same transaction as the change they
+# announce, and delivered later by a background worker. A claimed notification is hidden for
+# NOTIFICATION_RETRY_DELAY, so if its delivery fails (or the bot dies) it is simply retried then.
+NOTIFICATION_RETRY_DELAY = datetime.timedelta(minutes=5)
+NOTIFICATION_MAX_ATTEMPTS = 5
+RUNAWAY_MESSAGE = "You neglected your pet, **{pet_name}**, for too long. It has lost all its Willpower and run away. 😥"
+
+# Optional write-behind buffer for pet stats, see enable_stat_write_behind().
+# Maps user_id to the pet's buffered state: {"last_decay", "stats": {def_id: [value, last_updated]}, "dirty": set of def_ids},
+# with the timestamps as Unix epoch seconds.
+_stat_buffer: dict[int, dict] = {}
+_stat_buffer_lock = threading.Lock()
+_stat_flush_interval: float | None = None
+
+# Set by shutdown_db_threads() to stop the background threads that feed the write executor
+_shutting_down = threading.Event()
+
+# In a cluster worker (see launcher.py) writes are sent to the writer process instead of
+# running here. Set with set_remote_writer(), it is called as (function name, args, kwargs)
+# and returns (result, the writer's get_cache_versions()).
+_remote_writer = None
+_remote_cache_versions = None
+# The users who hatched a pet lately, as (hatch generation, user_id), so cluster workers can drop
+# the cooldowns they recorded for the previous pets. See users_hatched_since().
+RECENT_HATCHES_SIZE = 1000
+_recent_hatches: collections.deque[tuple[int, int]] = collections.deque(maxlen=RECENT_HATCHES_SIZE)
+_hatch_generation = 0
+# Every blocking function that writes, by name: the ones a writer process may run for a worker
+WRITE_FUNCTIONS = {}
+
+# The top LEADERBOARD_CACHE_SIZE entries of each stat's leaderboard are kept in memory,
+# keyed by def_id, until they expire or a change that could reorder them comes in.
+LEADERBOARD_CACHE_SIZE = 50
+LEADERBOARD_CACHE_TTL = datetime.timedelta(seconds=30)
+_leaderboard_cache: dict[int, tuple[datetime.datetime, list[dict]]] = {}
+_leaderboard_lock = threading.Lock()
+# Bumped by every invalidation, so a board computed before one is never cached after it
+_leaderboard_generation = 0
+
+# In-memory copy of the shop table, keyed by item_id and ordered by price.
+# The version is bumped on every refresh so views built from the catalogue know when they are stale.
+_shop_catalogue: dict[str, dict] = {}
+_visible_shop_items: list[dict] = []
+_shop_catalogue_version = 0
+# The prize drop table, rebuilt with the catalogue: the rarity tiers keyed by name, every item's
+# chance of being the prize, and a sampler that draws prizes with those chances
+_prize_tiers: dict[str, dict] = {}
+_prize_odds: list[tuple[dict, float]] = []
+_prize_sampler: AliasSampler | None = None
+
 INITIAL_SHOP_ITEMS = {
     "apple": {
         "name": "Apple 🍎",
@@ -39,18 +126,56 @@ INITIAL_SHOP_ITEMS = {
 }
 
 
-@contextmanager
-def get_db_cursor():
-    """A context manager to handle database connection and transactions."""
-    con = sqlite3.connect(DB_FILE)
+def _open_connection():
+    """Opens a connection configured for the bot: WAL journal, foreign keys and a statement cache."""
+    con = sqlite3.connect(DB_FILE, cached_statements=DB_STATEMENT_CACHE_SIZE)
     con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode = WAL")
+    # In WAL mode NORMAL is still crash-safe, it only skips the fsync on every commit
+    con.execute("PRAGMA synchronous = NORMAL")
     con.execute("PRAGMA foreign_keys = ON")
+    con.execute("PRAGMA busy_timeout = 5000")
+    return con
+
+
+def _get_connection():
+    """Returns the calling thread's connection, opening it on first use."""
+    con = getattr(_connections, "con", None)
+    if con is None:
+        con = _open_connection()
+        _connections.con = con
+        _connections.depth = 0
+    return con
+
+
+@contextmanager
+def get_db_cursor():
+    """
+    A context manager to handle database transactions on the thread's pooled connection.
+    Nested uses share the outermost transaction, which commits (or rolls back) on exit.
+    """
+    con = _get_connection()
+    _connections.depth += 1
     try:
-        cur = con.cursor()
+        # Every statement is timed for the metrics and the slow query log
+        cur = TimedCursor(con.cursor())
         yield cur
-        con.commit()
+        if _connections.depth == 1:
+            con.commit()
+    except BaseException:
+        if _connections.depth == 1:
+            con.rollback()
+        raise
     finally:
+        _connections.depth -= 1
+
+
+def close_connection():
+    """Closes the calling thread's pooled connection, if it has one."""
+    con = getattr(_connections, "con", None)
+    if con is not None:
         con.close()
+        _connections.con = None
 
 
 def setup_database():
@@ -158,7 +283,7 @@ def setup_database():
             print("Shop table is empty, populating with initial items...")
             for item_id, details in INITIAL_SHOP_ITEMS.items():
                 cur.execute(
-                    "INSERT INTO shop VALUES (?, ?, ?, ?, ?, ?, 1)",
+                    "INSERT INTO shop (item_id, name, price, description, effect_stat, effect_value) VALUES (?, ?, ?, ?, ?, ?)",
                     (
                         item_id,
                         details["name"],
@@ -169,41 +294,764 @@ def setup_database():
                     ),
                 )
 
+    _run_migrations()
+    warm_caches()
 
-def get_stat_definition_id(stat_name):
-    """Get a stat's ID from its name."""
     with get_db_cursor() as cur:
+        cur.execute("SELECT 1 FROM legacy_timestamp_backlog LIMIT 1")
+        if cur.fetchone():
+            _convert_legacy_timestamps_in_background()
+
+
+def warm_caches():
+    """Loads the in-memory caches so the hot paths never have to. setup_database() already does this."""
+    refresh_stat_definitions()
+    refresh_shop_catalogue()
+
+
+def _migrate_add_last_decay(cur):
+    """Adds pets.last_decay, the watermark used to apply stat decay lazily."""
+    cur.execute("ALTER TABLE pets ADD COLUMN last_decay TEXT")
+    # Existing pets were kept up to date by the old decay sweep, so they start decaying from now
+    cur.execute(
+        "UPDATE pets SET last_decay = ?", (datetime.datetime.now().isoformat(),)
+    )
+
+
+def _migrate_add_indexes(cur):
+    """Makes (owner_id, def_id) unique in pet_stats and indexes the per-owner and leaderboard lookups."""
+    # Keep only the newest row of any duplicated stat, it is the one fetch_pet used to show
+    cur.execute(
+        """
+        DELETE FROM pet_stats WHERE stat_id NOT IN (
+            SELECT MAX(stat_id) FROM pet_stats GROUP BY owner_id, def_id
+        )
+    """
+    )
+    cur.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_pet_stats_owner_def ON pet_stats (owner_id, def_id)"
+    )
+    # Leaderboards and the runaway check look stats up by definition and value
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_pet_stats_def_value ON pet_stats (def_id, stat_value)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_inventory_owner_item ON inventory (owner_id, item_id)"
+    )
+
+
+def _migrate_inventory_quantities(cur):
+    """Stores one inventory row per (owner, item) with a quantity, instead of one row per copy."""
+    cur.execute(
+        """
+        CREATE TABLE inventory_quantities (
+            owner_id INTEGER NOT NULL, item_id TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            PRIMARY KEY (owner_id, item_id),
+            FOREIGN KEY(item_id) REFERENCES shop(item_id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+    """
+    )
+    cur.execute(
+        """
+        INSERT INTO inventory_quantities (owner_id, item_id, quantity)
+        SELECT owner_id, item_id, COUNT(*) FROM inventory GROUP BY owner_id, item_id
+    """
+    )
+    cur.execute("DROP TABLE inventory")
+    cur.execute("ALTER TABLE inventory_quantities RENAME TO inventory")
+
+
+def _migrate_leaderboard_index(cur):
+    """Extends the (def_id, stat_value) index with owner_id, so leaderboards can page through it."""
+    cur.execute("DROP INDEX IF EXISTS idx_pet_stats_def_value")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_pet_stats_leaderboard ON pet_stats (def_id, stat_value, owner_id)"
+    )
+
+
+def _migrate_add_notification_outbox(cur):
+    """Adds the outbox of DMs waiting to be delivered."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL
+        )
+    """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox (next_attempt_at)"
+    )
+
+
+def _migrate_add_epoch_timestamps(cur):
+    """
+    Adds INTEGER Unix epoch columns next to the ISO-8601 TEXT timestamps of pets and pet_stats.
+    The existing rows are converted afterwards, in chunks, by convert_legacy_timestamps().
+    Until then readers fall back to the TEXT column with COALESCE(x_ts, x).
+    """
+    cur.execute("ALTER TABLE pets ADD COLUMN born_ts INTEGER")
+    cur.execute("ALTER TABLE pets ADD COLUMN last_prize_ts INTEGER")
+    cur.execute("ALTER TABLE pets ADD COLUMN last_decay_ts INTEGER")
+    cur.execute("ALTER TABLE pet_stats ADD COLUMN last_updated_ts INTEGER")
+
+    # Rows up to these keys still need converting. Later rows are written with epoch timestamps.
+    cur.execute(
+        """
+        CREATE TABLE legacy_timestamp_backlog (
+            table_name TEXT PRIMARY KEY, next_key INTEGER NOT NULL, last_key INTEGER NOT NULL
+        )
+    """
+    )
+    cur.execute(
+        """
+        INSERT INTO legacy_timestamp_backlog
+        SELECT 'pets', MIN(user_id), MAX(user_id) FROM pets HAVING COUNT(*) > 0
+        UNION ALL
+        SELECT 'pet_stats', MIN(stat_id), MAX(stat_id) FROM pet_stats HAVING COUNT(*) > 0
+    """
+    )
+
+    # The outbox only ever holds a handful of rows, so it is simply rebuilt
+    cur.execute("SELECT * FROM notification_outbox")
+    notifications = [
+        (row["notification_id"], row["user_id"], row["message"], row["attempts"], _epoch(row["next_attempt_at"]))
+        for row in cur.fetchall()
+    ]
+    cur.execute("DROP TABLE notification_outbox")
+    cur.execute(
+        """
+        CREATE TABLE notification_outbox (
+            notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL
+        )
+    """
+    )
+    cur.execute(
+        "CREATE INDEX idx_notification_outbox_due ON notification_outbox (next_attempt_at)"
+    )
+    cur.executemany("INSERT INTO notification_outbox VALUES (?, ?, ?, ?, ?)", notifications)
+
+
+def _migrate_add_prize_drop_table(cur):
+    """
+    Adds rarity tiers and per-item weights for !prize. A tier's weight is its share of the prizes,
+    an item's weight is its share within its tier. Every item starts out common, with the same
+    weight, so the prize odds only change once an admin edits them.
+    """
+    cur.execute(
+        """
+        CREATE TABLE prize_tiers (
+            tier TEXT PRIMARY KEY,
+            weight INTEGER NOT NULL,
+            display_name TEXT NOT NULL
+        )
+    """
+    )
+    cur.executemany(
+        "INSERT INTO prize_tiers VALUES (?, ?, ?)",
+        [
+            ("common", 60, "⚪ Common"),
+            ("uncommon", 25, "🟢 Uncommon"),
+            ("rare", 12, "🔵 Rare"),
+            ("legendary", 3, "🟡 Legendary"),
+        ],
+    )
+    cur.execute("ALTER TABLE shop ADD COLUMN prize_tier TEXT NOT NULL DEFAULT 'common'")
+    cur.execute("ALTER TABLE shop ADD COLUMN prize_weight INTEGER NOT NULL DEFAULT 1")
+
+
+# Schema changes applied in order on top of the tables created in setup_database().
+# The number of migrations already applied is stored in the database's user_version.
+MIGRATIONS = [
+    _migrate_add_last_decay,
+    _migrate_add_indexes,
+    _migrate_inventory_quantities,
+    _migrate_leaderboard_index,
+    _migrate_add_notification_outbox,
+    _migrate_add_epoch_timestamps,
+    _migrate_add_prize_drop_table,
+]
+
+
+def _run_migrations():
+    """Brings the database schema up to date, one transaction per migration."""
+    with get_db_cursor() as cur:
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Migrating the database to schema version {number}...")
+        with get_db_cursor() as cur:
+            cur.execute("BEGIN IMMEDIATE")
+            migration(cur)
+            cur.execute(f"PRAGMA user_version = {number}")
+
+
+# Rows converted per transaction by the background timestamp conversion, and the pause between
+# chunks that lets the commands' own writes through
+TIMESTAMP_CONVERSION_CHUNK = 5000
+TIMESTAMP_CONVERSION_PAUSE = 0.05
+
+# For each table with legacy ISO-8601 timestamps: its key and its (TEXT column, epoch column) pairs
+_LEGACY_TIMESTAMP_COLUMNS = {
+    "pets": ("user_id", (("born_at", "born_ts"), ("last_prize", "last_prize_ts"), ("last_decay", "last_decay_ts"))),
+    "pet_stats": ("stat_id", (("last_updated", "last_updated_ts"),)),
+}
+
+
+def _convert_legacy_timestamps_chunk(chunk_size: int) -> int | None:
+    """
+    Converts the next chunk of rows left by _migrate_add_epoch_timestamps() in one transaction.
+    Epoch values written since the migration are kept. Returns the number of rows done, or None once none are left.
+    """
+    with get_db_cursor() as cur:
+        cur.execute("SELECT table_name, next_key, last_key FROM legacy_timestamp_backlog LIMIT 1")
+        backlog = cur.fetchone()
+        if not backlog:
+            return None
+
+        table = backlog["table_name"]
+        key, columns = _LEGACY_TIMESTAMP_COLUMNS[table]
         cur.execute(
-            "SELECT def_id FROM stat_definitions WHERE stat_name = ?", (stat_name,)
+            f"SELECT {key}, {', '.join(legacy for legacy, _ in columns)} FROM {table} "
+            f"WHERE {key} BETWEEN ? AND ? ORDER BY {key} LIMIT ?",
+            (backlog["next_key"], backlog["last_key"], chunk_size),
         )
-        result = cur.fetchone()
-        return result["def_id"] if result else None
+        rows = cur.fetchall()
+        cur.executemany(
+            f"UPDATE {table} SET {', '.join(f'{ts} = COALESCE({ts}, ?)' for _, ts in columns)} WHERE {key} = ?",
+            [(*(_epoch(row[legacy]) for legacy, _ in columns), row[key]) for row in rows],
+        )
+
+        if len(rows) < chunk_size:
+            cur.execute("DELETE FROM legacy_timestamp_backlog WHERE table_name = ?", (table,))
+        else:
+            cur.execute(
+                "UPDATE legacy_timestamp_backlog SET next_key = ? WHERE table_name = ?",
+                (rows[-1][key] + 1, table),
+            )
+        return len(rows)
+
+
+def _convert_legacy_timestamps_in_background():
+    """Converts the legacy timestamps chunk by chunk on the write thread, between the other writes."""
+
+    def convert():
+        print("Converting legacy timestamps to epoch seconds in the background...")
+        converted = 0
+        while not _shutting_down.is_set():
+            try:
+                done = _db_write_executor.submit(
+                    _convert_legacy_timestamps_chunk, TIMESTAMP_CONVERSION_CHUNK
+                ).result()
+            except RuntimeError:
+                # The executor was shut down, the next start picks up where this left off
+                return
+            if done is None:
+                print(f"Converted the timestamps of {converted} rows.")
+                return
+            converted += done
+            time.sleep(TIMESTAMP_CONVERSION_PAUSE)
+
+    threading.Thread(
+        target=convert, name="pawder-db-timestamps", daemon=True
+    ).start()
+
+
+def refresh_stat_definitions():
+    """(Re)loads the stat registry from the database. Call after any change to stat_definitions."""
+    global _stat_registry, _stat_registry_version
+    with get_db_cursor() as cur:
+        cur.execute("SELECT * FROM stat_definitions ORDER BY def_id")
+        definitions = [dict(row) for row in cur.fetchall()]
+
+    # Cooldowns recorded under a definition that changed or went away may no longer hold
+    by_name = {definition["stat_name"]: definition for definition in definitions}
+    for stat_name, previous in _stat_registry[0].items():
+        current = by_name.get(stat_name)
+        if current is None or current["cooldown_seconds"] != previous["cooldown_seconds"]:
+            cooldowns.forget_stat(stat_name)
+
+    _stat_registry = (
+        {definition["stat_name"]: definition for definition in definitions},
+        {definition["def_id"]: definition for definition in definitions},
+        StatLayout(definitions),
+    )
+    _stat_registry_version += 1
+
+
+def get_stat_definitions() -> dict[str, dict]:
+    """Returns every stat definition, keyed by stat name. Served from memory."""
+    return _stat_registry[0]
+
+
+def get_stat_definition(stat_name) -> dict | None:
+    """Returns a stat's definition from its name. Served from memory."""
+    return _stat_registry[0].get(stat_name)
+
+
+def get_stat_definition_id(stat_name):
+    """Get a stat's ID from its name. Served from memory."""
+    definition = _stat_registry[0].get(stat_name)
+    return definition["def_id"] if definition else None
+
+
+def _epoch(value) -> int | None:
+    """
+    Returns a stored timestamp as Unix epoch seconds. Rows the timestamp migration
+    hasn't converted yet still hold (local time) ISO-8601 text.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if not value:
+        return None
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+
+# SQL equivalent of _epoch() for pets.last_decay
+_LAST_DECAY_SQL = "COALESCE(p.last_decay_ts, CAST(strftime('%s', p.last_decay, 'utc') AS INTEGER))"
+
+
+def _pending_decay_ticks(last_decay: int | None, now: int) -> int:
+    """Returns how many decay ticks have passed since a pet's last_decay watermark."""
+    if last_decay is None:
+        return 0
+    return max(0, (now - last_decay) // DECAY_TICK_SECONDS)
+
+
+def _apply_decay_ticks(values: dict[int, int], ticks: int) -> dict[int, int]:
+    """
+    Returns a pet's stat values (keyed by def_id) after 'ticks' rounds of decay.
+    Every round lowers each decaying stat by its decay_amount, then takes
+    NEGLECT_WILLPOWER_PENALTY willpower if any decaying stat has reached 0.
+    """
+    if ticks <= 0:
+        return values
+
+    definitions = _stat_registry[1]
+    decayed = dict(values)
+    first_neglected_tick = None
+    for def_id, value in values.items():
+        definition = definitions.get(def_id)
+        decay = definition["decay_amount"] if definition else None
+        if not decay or decay <= 0:
+            continue
+
+        decayed[def_id] = max(0, value - ticks * decay)
+        # The round in which this stat reaches 0 (the first one if it already is)
+        zero_tick = max(1, -(-value // decay))
+        if first_neglected_tick is None or zero_tick < first_neglected_tick:
+            first_neglected_tick = zero_tick
+
+    willpower_id = get_stat_definition_id("willpower")
+    if first_neglected_tick is not None and willpower_id in decayed:
+        neglected_ticks = max(0, ticks - first_neglected_tick + 1)
+        decayed[willpower_id] = max(
+            0, decayed[willpower_id] - neglected_ticks * NEGLECT_WILLPOWER_PENALTY
+        )
+    return decayed
+
+
+def _has_run_away(values: dict[int, int]) -> bool:
+    """Whether a pet with these stat values has lost all its willpower."""
+    willpower_id = get_stat_definition_id("willpower")
+    return willpower_id in values and values[willpower_id] <= 0
+
+
+def _settle_decay(cur, user_id, now: int) -> bool:
+    """
+    Writes a pet's pending decay to the database and moves its watermark forward.
+    Returns False if the user has no pet.
+    """
+    return user_id in _settle_decay_for_pets(cur, [user_id], now)
+
+
+def _settle_decay_for_pets(cur, user_ids, now: int) -> list[int]:
+    """
+    Writes the pending decay of many pets to the database, with a handful of statements,
+    and moves their watermarks forward. Returns the ids of the users among 'user_ids' that have a pet.
+    """
+    cur.execute(
+        "SELECT user_id, COALESCE(last_decay_ts, last_decay) AS last_decay FROM pets WHERE user_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(user_ids)),),
+    )
+    owners = []
+    decaying = {}
+    for pet in cur.fetchall():
+        owners.append(pet["user_id"])
+        last_decay = _epoch(pet["last_decay"])
+        ticks = _pending_decay_ticks(last_decay, now)
+        if ticks > 0:
+            decaying[pet["user_id"]] = (last_decay, ticks)
+    if not decaying:
+        return owners
+
+    cur.execute(
+        "SELECT owner_id, def_id, stat_value FROM pet_stats WHERE owner_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(decaying)),),
+    )
+    values_by_owner = {}
+    for stat in cur.fetchall():
+        values_by_owner.setdefault(stat["owner_id"], {})[stat["def_id"]] = stat["stat_value"]
+
+    stat_rows = []
+    for user_id, values in values_by_owner.items():
+        decayed = _apply_decay_ticks(values, decaying[user_id][1])
+        stat_rows.extend(
+            (value, user_id, def_id) for def_id, value in decayed.items() if value != values[def_id]
+        )
+    cur.executemany(
+        "UPDATE pet_stats SET stat_value = ? WHERE owner_id = ? AND def_id = ?", stat_rows
+    )
+    # Keep the unfinished part of the current tick
+    cur.executemany(
+        "UPDATE pets SET last_decay_ts = ? WHERE user_id = ?",
+        [
+            (last_decay + ticks * DECAY_TICK_SECONDS, user_id)
+            for user_id, (last_decay, ticks) in decaying.items()
+        ],
+    )
+    return owners
 
 
 def fetch_pet(user_id) -> Pet | None:
-    """Fetches a pet and joins its stats with their stat definitions."""
+    """
+    Fetches a pet and joins its stats with their stat definitions.
+    Pending decay is applied to the returned values without being written back.
+    Returns None if the user has no pet, or if it has run away.
+    """
+    # Changes still sitting in the write-behind buffer take precedence over the database. The buffer
+    # is read first: a flush committing after this leaves the rows read below at least as new.
+    buffered = _get_buffered_pet(user_id)
     with get_db_cursor() as cur:
-        cur.execute("SELECT * FROM pets WHERE user_id = ?", (user_id,))
+        cur.execute(
+            """
+            SELECT name, COALESCE(born_ts, born_at) AS born_at, COALESCE(last_prize_ts, last_prize) AS last_prize,
+                COALESCE(last_decay_ts, last_decay) AS last_decay
+            FROM pets WHERE user_id = ?
+        """,
+            (user_id,),
+        )
         pet_core = cur.fetchone()
         if not pet_core:
             return None
 
-        pet_data = dict(pet_core)
+        cur.execute(
+            "SELECT def_id, stat_value, COALESCE(last_updated_ts, last_updated) FROM pet_stats WHERE owner_id = ?",
+            (user_id,),
+        )
+        stats = cur.fetchall()
+
+        last_decay = _epoch(pet_core["last_decay"])
+        if buffered:
+            last_decay, buffered_stats = buffered
+            stats = [
+                (stat[0], *buffered_stats[stat[0]]) if stat[0] in buffered_stats else stat
+                for stat in stats
+            ]
+
+        ticks = _pending_decay_ticks(last_decay, int(time.time()))
+        values = _apply_decay_ticks({stat[0]: stat[1] for stat in stats}, ticks)
+        if _has_run_away(values):
+            # It is gone, the runaway check will delete it and tell its owner
+            return None
+
+        # Lay the values out in registry order, stats without a definition are skipped
+        layout = _stat_registry[2]
+        stat_values = [None] * len(layout.definitions)
+        last_updated = [None] * len(layout.definitions)
+        for def_id, _, stat_last_updated in stats:
+            index = layout.by_def_id.get(def_id)
+            if index is not None:
+                stat_values[index] = values[def_id]
+                last_updated[index] = _epoch(stat_last_updated)
+
+        return Pet(
+            pet_core["name"],
+            pet_core["born_at"],
+            pet_core["last_prize"],
+            layout,
+            stat_values,
+            last_updated,
+        )
 
+
+# Changes a stat and clamps it to its cap in a single statement, so there is no
+# read-modify-write window. Stats without a cap, like money, have no upper bound,
+# but taking from them stops at 0.
+_MODIFY_STAT_SQL = """
+    UPDATE pet_stats
+    SET stat_value = CASE
+            WHEN :cap IS NULL AND :amount < 0 THEN MAX(0, {new_value})
+            WHEN :cap IS NULL THEN {new_value}
+            ELSE MAX(0, MIN(:cap, {new_value}))
+        END,
+        last_updated_ts = :now
+    WHERE {owners} AND def_id = :def_id
+    RETURNING owner_id, stat_value
+"""
+_ADD_TO_STAT_SQL = _MODIFY_STAT_SQL.format(new_value="stat_value + :amount", owners="owner_id = :owner_id")
+_SET_STAT_SQL = _MODIFY_STAT_SQL.format(new_value=":amount", owners="owner_id = :owner_id")
+# The same for every pet whose owner is in the JSON array :owner_ids
+_OWNERS_IN_JSON_SQL = "owner_id IN (SELECT value FROM json_each(:owner_ids))"
+_ADD_TO_STATS_SQL = _MODIFY_STAT_SQL.format(new_value="stat_value + :amount", owners=_OWNERS_IN_JSON_SQL)
+_SET_STATS_SQL = _MODIFY_STAT_SQL.format(new_value=":amount", owners=_OWNERS_IN_JSON_SQL)
+
+
+def _clamp_stat(value, cap, amount):
+    # The same rules as _MODIFY_STAT_SQL: within the cap if there is one, and never taken below 0
+    if cap is not None:
+        return max(0, min(cap, value))
+    if amount < 0:
+        return max(0, value)
+    return value
+
+
+def _get_buffered_pet(user_id):
+    """Returns a copy of a pet's (last_decay, {def_id: (value, last_updated)}) from the write-behind buffer, if any."""
+    with _stat_buffer_lock:
+        entry = _stat_buffer.get(user_id)
+        if not entry:
+            return None
+        return entry["last_decay"], {
+            def_id: tuple(stat) for def_id, stat in entry["stats"].items()
+        }
+
+
+def _modify_buffered_pet_stats(cur, user_id, deltas, sets, now: int):
+    """Like _modify_pet_stats(), but the changes only go to the write-behind buffer."""
+    with _stat_buffer_lock:
+        entry = _stat_buffer.get(user_id)
+
+    if not entry:
+        # First change since the last flush, load the pet's current state once
         cur.execute(
-            """
-            SELECT sd.stat_name, ps.stat_value, sd.cap, ps.last_updated, sd.cooldown_seconds, sd.display_name
-            FROM pet_stats ps
-            JOIN stat_definitions sd ON ps.def_id = sd.def_id
-            WHERE ps.owner_id = ?
-        """,
+            "SELECT COALESCE(last_decay_ts, last_decay) AS last_decay FROM pets WHERE user_id = ?",
+            (user_id,),
+        )
+        pet_core = cur.fetchone()
+        if not pet_core:
+            return None
+        cur.execute(
+            "SELECT def_id, stat_value, COALESCE(last_updated_ts, last_updated) AS last_updated FROM pet_stats WHERE owner_id = ?",
             (user_id,),
         )
+        entry = {
+            "last_decay": _epoch(pet_core["last_decay"]),
+            "stats": {
+                stat["def_id"]: [stat["stat_value"], _epoch(stat["last_updated"])]
+                for stat in cur.fetchall()
+            },
+            "dirty": set(),
+        }
 
-        stats = cur.fetchall()
-        pet_data["stats"] = {stat["stat_name"]: dict(stat) for stat in stats}
+    new_values = {}
+    with _stat_buffer_lock:
+        _stat_buffer[user_id] = entry
+        stats = entry["stats"]
+
+        # Settle the pending decay in the buffer too
+        ticks = _pending_decay_ticks(entry["last_decay"], now)
+        if ticks > 0:
+            values = {def_id: stat[0] for def_id, stat in stats.items()}
+            for def_id, value in _apply_decay_ticks(values, ticks).items():
+                if value != values[def_id]:
+                    stats[def_id][0] = value
+                    entry["dirty"].add(def_id)
+            entry["last_decay"] += ticks * DECAY_TICK_SECONDS
+
+        changes = [(stat_name, amount, "set") for stat_name, amount in (sets or {}).items()]
+        changes += [(stat_name, amount, "add") for stat_name, amount in (deltas or {}).items()]
+        for stat_name, amount, mode in changes:
+            definition = get_stat_definition(stat_name)
+            if not definition or definition["def_id"] not in stats:
+                new_values[stat_name] = None
+                continue
 
-        return Pet(pet_data)
+            stat = stats[definition["def_id"]]
+            new_value = stat[0] + amount if mode == "add" else amount
+            stat[0] = _clamp_stat(new_value, definition["cap"], amount)
+            stat[1] = now
+            entry["dirty"].add(definition["def_id"])
+            new_values[stat_name] = stat[0]
+
+    # Leaderboards are read from the database, so they are only invalidated by the flush
+    return new_values
+
+
+def _modify_pet_stats(cur, user_id, deltas, sets, now: int):
+    """Applies 'sets' then 'deltas' to one pet inside the caller's transaction. See modify_pet_stats()."""
+    if _stat_flush_interval:
+        return _modify_buffered_pet_stats(cur, user_id, deltas, sets, now)
+
+    if not _settle_decay(cur, user_id, now):
+        return None
+
+    changes = [(stat_name, amount, _SET_STAT_SQL) for stat_name, amount in (sets or {}).items()]
+    changes += [(stat_name, amount, _ADD_TO_STAT_SQL) for stat_name, amount in (deltas or {}).items()]
+
+    new_values = {}
+    for stat_name, amount, sql in changes:
+        definition = get_stat_definition(stat_name)
+        if not definition:
+            new_values[stat_name] = None
+            continue
+
+        cur.execute(
+            sql,
+            {
+                "cap": definition["cap"],
+                "amount": amount,
+                "now": now,
+                "owner_id": user_id,
+                "def_id": definition["def_id"],
+            },
+        )
+        result = cur.fetchone()
+        new_values[stat_name] = result["stat_value"] if result else None
+    return new_values
+
+
+def _invalidate_changed_stats(user_id, new_values):
+    """
+    Invalidates the leaderboards a pet's new stat values could change. Call it once they are committed,
+    so a board rebuilt in between can't be cached with the old values.
+    """
+    for stat_name, value in new_values.items():
+        if value is not None:
+            _invalidate_leaderboard(get_stat_definition_id(stat_name), user_id, value)
+
+
+def flush_stat_buffer():
+    """Writes every buffered stat change to the database in one transaction."""
+    with _stat_buffer_lock:
+        entries = list(_stat_buffer.items())
+    if not entries:
+        return
+
+    with _stat_buffer_lock:
+        stat_rows = [
+            (entry["stats"][def_id][0], entry["stats"][def_id][1], user_id, def_id)
+            for user_id, entry in entries
+            for def_id in entry["dirty"]
+        ]
+        decay_rows = [(entry["last_decay"], user_id) for user_id, entry in entries]
+
+    with get_db_cursor() as cur:
+        cur.executemany(
+            "UPDATE pet_stats SET stat_value = ?, last_updated_ts = ? WHERE owner_id = ? AND def_id = ?",
+            stat_rows,
+        )
+        cur.executemany("UPDATE pets SET last_decay_ts = ? WHERE user_id = ?", decay_rows)
+
+    # Only now can a rebuilt leaderboard see the new values
+    for def_id in {row[3] for row in stat_rows}:
+        _invalidate_leaderboard(def_id)
+
+    # Only drop the entries once they are committed. Readers take their copy of the buffer before
+    # querying the database, so they never see older values in between.
+    with _stat_buffer_lock:
+        for user_id, entry in entries:
+            if _stat_buffer.get(user_id) is entry:
+                del _stat_buffer[user_id]
+
+
+def _report_flush_failure(future):
+    # The buffer is kept when a flush fails, the next one tries again
+    if future.exception() is not None:
+        print(f"Failed to flush the stat buffer: {future.exception()!r}")
+
+
+def enable_stat_write_behind(flush_interval: float):
+    """
+    Buffers stat changes in memory and writes them to the database every 'flush_interval' seconds
+    (and at shutdown), turning bursts of care commands into a handful of commits.
+    Reads see buffered changes immediately, but up to 'flush_interval' seconds of changes
+    can be lost if the process dies.
+    """
+    global _stat_flush_interval
+    _stat_flush_interval = flush_interval
+
+    def flush_periodically():
+        while not _shutting_down.wait(flush_interval):
+            _db_write_executor.submit(flush_stat_buffer).add_done_callback(_report_flush_failure)
+
+    threading.Thread(
+        target=flush_periodically, name="pawder-db-flush", daemon=True
+    ).start()
+
+
+def modify_pet_stats(user_id, deltas=None, sets=None) -> dict[str, int | None] | None:
+    """
+    Modifies several of a pet's stats in a single transaction.
+    - user_id: The ID of the user whose pet to modify.
+    - deltas: {stat_name: amount} to add to each stat.
+    - sets: {stat_name: value} to set each stat to, applied before the deltas.
+    Every new value is clamped to its stat's cap.
+    Returns {stat_name: new value} (None for stats the pet doesn't have), or None if the pet doesn't exist.
+    """
+    with get_db_cursor() as cur:
+        new_values = _modify_pet_stats(cur, user_id, deltas, sets, int(time.time()))
+
+    # Buffered changes invalidate once they are flushed
+    if new_values and not _stat_flush_interval:
+        _invalidate_changed_stats(user_id, new_values)
+    return new_values
+
+
+def modify_stats_for_pets(user_ids, deltas=None, sets=None) -> dict[int, dict[str, int | None]]:
+    """
+    Applies the same stat changes to many pets in a single transaction, see modify_pet_stats().
+    Returns {user_id: {stat_name: new value}} for the users that have a pet.
+    """
+    now = int(time.time())
+    with get_db_cursor() as cur:
+        if _stat_flush_interval:
+            # Buffered changes are made pet by pet
+            results = {}
+            for user_id in user_ids:
+                new_values = _modify_pet_stats(cur, user_id, deltas, sets, now)
+                if new_values is not None:
+                    results[user_id] = new_values
+            return results
+
+        owners = _settle_decay_for_pets(cur, user_ids, now)
+        results = {user_id: {} for user_id in owners}
+
+        changes = [(stat_name, amount, _SET_STATS_SQL) for stat_name, amount in (sets or {}).items()]
+        changes += [(stat_name, amount, _ADD_TO_STATS_SQL) for stat_name, amount in (deltas or {}).items()]
+        for stat_name, amount, sql in changes:
+            for new_values in results.values():
+                new_values[stat_name] = None
+            definition = get_stat_definition(stat_name)
+            if not definition or not owners:
+                continue
+
+            # One statement per stat, whatever the number of pets
+            cur.execute(
+                sql,
+                {
+                    "cap": definition["cap"],
+                    "amount": amount,
+                    "now": now,
+                    "owner_ids": json.dumps(owners),
+                    "def_id": definition["def_id"],
+                },
+            )
+            for row in cur.fetchall():
+                results[row["owner_id"]][stat_name] = row["stat_value"]
+
+    if results:
+        _invalidate_leaderboard()
+    return results
 
 
 def modify_pet_stat(user_id, stat_name, amount, mode="add"):
@@ -215,53 +1063,813 @@ def modify_pet_stat(user_id, stat_name, amount, mode="add"):
     - mode: 'add' (default) or 'set'.
     Returns the new value of the stat, or None if the pet doesn't exist.
     """
-    def_id = get_stat_definition_id(stat_name)
-    if not def_id:
+    if mode == "set":
+        new_values = modify_pet_stats(user_id, sets={stat_name: amount})
+    else:
+        new_values = modify_pet_stats(user_id, deltas={stat_name: amount})
+    return new_values[stat_name] if new_values else None
+
+
+def refresh_shop_catalogue():
+    """(Re)loads the shop catalogue from the database. Call after any change to the shop table."""
+    global _shop_catalogue, _visible_shop_items, _shop_catalogue_version
+    global _prize_tiers, _prize_odds, _prize_sampler
+    with get_db_cursor() as cur:
+        cur.execute("SELECT * FROM shop ORDER BY price ASC")
+        catalogue = {row["item_id"]: dict(row) for row in cur.fetchall()}
+        cur.execute("SELECT item_id FROM shop WHERE is_visible = 1 ORDER BY price ASC")
+        visible_items = [catalogue[row["item_id"]] for row in cur.fetchall()]
+        cur.execute("SELECT * FROM prize_tiers ORDER BY weight DESC")
+        tiers = {row["tier"]: dict(row) for row in cur.fetchall()}
+
+    odds = _compute_prize_odds(catalogue.values(), tiers)
+    _shop_catalogue = catalogue
+    _visible_shop_items = visible_items
+    _prize_tiers = tiers
+    _prize_odds = odds
+    _prize_sampler = AliasSampler(odds) if odds else None
+    _shop_catalogue_version += 1
+
+
+def _compute_prize_odds(items, tiers) -> list[tuple[dict, float]]:
+    """
+    Returns (item, chance) for every item that can be won, most likely first. The tiers without any
+    winnable item don't take part, so their share goes to the others.
+    """
+    tier_totals = {}
+    for item in items:
+        tier = tiers.get(item["prize_tier"])
+        if tier and tier["weight"] > 0 and item["prize_weight"] > 0:
+            tier_totals[item["prize_tier"]] = tier_totals.get(item["prize_tier"], 0) + item["prize_weight"]
+    total_tier_weight = sum(tiers[name]["weight"] for name in tier_totals)
+
+    odds = [
+        (
+            item,
+            tiers[item["prize_tier"]]["weight"] / total_tier_weight
+            * item["prize_weight"] / tier_totals[item["prize_tier"]],
+        )
+        for item in items
+        if item["prize_tier"] in tier_totals and item["prize_weight"] > 0
+    ]
+    odds.sort(key=lambda entry: entry[1], reverse=True)
+    return odds
+
+
+def get_shop_catalogue_version() -> int:
+    """Returns a number that changes every time the shop catalogue is refreshed."""
+    return _shop_catalogue_version
+
+
+def fetch_all_shop_items():
+    """Fetches all shop items, cheapest first. Served from memory."""
+    return list(_shop_catalogue.values())
+
+
+def fetch_visible_shop_items():
+    """Fetches the items listed in the shop, cheapest first. Served from memory."""
+    return list(_visible_shop_items)
+
+
+def fetch_shop_item(item_id: str):
+    """Fetches a single shop item. Served from memory."""
+    return _shop_catalogue.get(item_id)
+
+
+def fetch_prize_tiers():
+    """Fetches the prize rarity tiers, most common first. Served from memory."""
+    return list(_prize_tiers.values())
+
+
+def get_prize_tier(tier: str):
+    """Fetches a single prize rarity tier. Served from memory."""
+    return _prize_tiers.get(tier)
+
+
+def fetch_prize_odds():
+    """Returns (item, chance between 0 and 1) for every item !prize can give, most likely first. Served from memory."""
+    return list(_prize_odds)
+
+
+def create_pet(user_id) -> bool:
+    """
+    Hatches a pet with every stat at its default value. Returns False if the user already has one.
+    A pet that has run away but wasn't removed by the runaway check yet is removed (and its owner told) first.
+    """
+    # The run away check below must see the buffered changes
+    if _get_buffered_pet(user_id):
+        flush_stat_buffer()
+
+    now = int(time.time())
+    with get_db_cursor() as cur:
+        cur.execute("SELECT user_id AS owner_id, name FROM pets WHERE user_id = ?", (user_id,))
+        existing = cur.fetchone()
+        if existing:
+            # fetch_pet already hides it from its owner, so hatching must not be refused either
+            _settle_decay(cur, user_id, now)
+            cur.execute("SELECT def_id, stat_value FROM pet_stats WHERE owner_id = ?", (user_id,))
+            if not _has_run_away({stat["def_id"]: stat["stat_value"] for stat in cur.fetchall()}):
+                return False
+            _delete_runaway_pets(cur, [existing], now)
+
+        # born_at is the legacy TEXT column, it is NOT NULL in the original schema
+        cur.execute(
+            "INSERT INTO pets (user_id, name, born_at, born_ts, last_decay_ts) VALUES (?, ?, '', ?, ?)",
+            (user_id, "Pet", now, now),
+        )
+
+        cur.executemany(
+            "INSERT INTO pet_stats (owner_id, def_id, stat_value) VALUES (?, ?, ?)",
+            [
+                (user_id, stat["def_id"], stat["default_value"])
+                for stat in get_stat_definitions().values()
+            ],
+        )
+
+    _invalidate_leaderboard()
+    _record_hatch(user_id)
+    return True
+
+
+def _record_hatch(user_id):
+    """Drops the cooldowns of a user's previous pet, here and (through the cache versions) in cluster workers."""
+    global _hatch_generation
+    _hatch_generation += 1
+    _recent_hatches.append((_hatch_generation, user_id))
+    cooldowns.forget(user_id)
+
+
+def users_hatched_since(generation: int) -> list[int] | None:
+    """
+    Returns the users who hatched a pet after the given hatch generation,
+    or None if too many did to still remember them all.
+    """
+    recent = list(_recent_hatches)
+    if generation < _hatch_generation and (not recent or recent[0][0] > generation + 1):
         return None
+    return [user_id for hatch, user_id in recent if hatch > generation]
+
+
+def rename_pet(user_id, new_name: str) -> bool:
+    """Renames a pet. Returns False if the user has no pet."""
+    with get_db_cursor() as cur:
+        cur.execute("UPDATE pets SET name = ? WHERE user_id = ?", (new_name, user_id))
+        renamed = cur.rowcount > 0
+
+    _invalidate_leaderboard()
+    return renamed
+
+
+def fetch_inventory(user_id):
+    """Fetches the item_id and quantity of every item a user owns."""
+    with get_db_cursor() as cur:
+        cur.execute(
+            "SELECT item_id, quantity FROM inventory WHERE owner_id = ?", (user_id,)
+        )
+        return cur.fetchall()
+
+
+def _add_inventory_item(cur, user_id, item_id: str, quantity: int):
+    cur.execute(
+        """
+        INSERT INTO inventory (owner_id, item_id, quantity) VALUES (?, ?, ?)
+        ON CONFLICT (owner_id, item_id) DO UPDATE SET quantity = quantity + excluded.quantity
+    """,
+        (user_id, item_id, quantity),
+    )
+
+
+def add_inventory_item(user_id, item_id: str, quantity: int = 1):
+    """Adds 'quantity' copies of an item to a user's inventory."""
+    with get_db_cursor() as cur:
+        _add_inventory_item(cur, user_id, item_id, quantity)
+
+
+def purchase_item(user_id, item_id: str, price: int) -> bool:
+    """
+    Takes 'price' coins from a user's pet and adds one copy of an item to their inventory, in one transaction.
+    Returns False, and changes nothing, if the user has no pet or not enough coins.
+    """
+    money = get_stat_definition("money")
+    if not money:
+        return False
+
+    now = int(time.time())
+    with get_db_cursor() as cur:
+        if _stat_flush_interval:
+            # Writes run one at a time on this thread, so nothing can spend the coins between the check and the debit
+            if _modify_buffered_pet_stats(cur, user_id, None, None, now) is None:
+                return False
+            _, stats = _get_buffered_pet(user_id)
+            if money["def_id"] not in stats or stats[money["def_id"]][0] < price:
+                return False
+            _modify_buffered_pet_stats(cur, user_id, {"money": -price}, None, now)
+        else:
+            if not _settle_decay(cur, user_id, now):
+                return False
+            cur.execute(
+                """
+                UPDATE pet_stats SET stat_value = stat_value - :price, last_updated_ts = :now
+                WHERE owner_id = :owner_id AND def_id = :def_id AND stat_value >= :price
+                RETURNING stat_value
+            """,
+                {"price": price, "now": now, "owner_id": user_id, "def_id": money["def_id"]},
+            )
+            result = cur.fetchone()
+            if not result:
+                return False
+            new_balance = result["stat_value"]
+
+        _add_inventory_item(cur, user_id, item_id, 1)
+
+    if not _stat_flush_interval:
+        _invalidate_changed_stats(user_id, {"money": new_balance})
+    return True
+
+
+def remove_inventory_item(user_id, item_id: str, quantity: int = 1):
+    """
+    Removes 'quantity' copies of an item from a user's inventory.
+    Returns a (removed, owned) tuple, where 'owned' is how many copies the user had.
+    Nothing is removed if the user owns fewer than 'quantity' copies.
+    """
+    with get_db_cursor() as cur:
+        cur.execute(
+            """
+            UPDATE inventory SET quantity = quantity - ?
+            WHERE owner_id = ? AND item_id = ? AND quantity >= ?
+            RETURNING quantity
+        """,
+            (quantity, user_id, item_id, quantity),
+        )
+        remaining = cur.fetchone()
 
+        if not remaining:
+            cur.execute(
+                "SELECT quantity FROM inventory WHERE owner_id = ? AND item_id = ?",
+                (user_id, item_id),
+            )
+            owned = cur.fetchone()
+            return False, owned["quantity"] if owned else 0
+
+        if remaining["quantity"] == 0:
+            cur.execute(
+                "DELETE FROM inventory WHERE owner_id = ? AND item_id = ?",
+                (user_id, item_id),
+            )
+        return True, remaining["quantity"] + quantity
+
+
+def add_inventory_item_for_pets(user_ids, item_id: str, quantity: int = 1) -> int:
+    """
+    Adds 'quantity' copies of an item to the inventory of every user in 'user_ids' who has a pet,
+    in one statement. Returns the number of users who got it.
+    """
     with get_db_cursor() as cur:
         cur.execute(
             """
-            SELECT ps.stat_value, sd.cap
+            INSERT INTO inventory (owner_id, item_id, quantity)
+            SELECT p.user_id, ?, ? FROM pets p
+            WHERE p.user_id IN (SELECT value FROM json_each(?))
+            ON CONFLICT (owner_id, item_id) DO UPDATE SET quantity = quantity + excluded.quantity
+        """,
+            (item_id, quantity, json.dumps(list(user_ids))),
+        )
+        return cur.rowcount
+
+
+def remove_inventory_item_for_users(user_ids, item_id: str, quantity: int = 1) -> tuple[int, int]:
+    """
+    Removes up to 'quantity' copies of an item from every user in 'user_ids', in one transaction.
+    Users with fewer copies lose all of them. Returns (users who lost some, copies removed).
+    """
+    params = {"item_id": item_id, "quantity": quantity, "user_ids": json.dumps(list(user_ids))}
+    owners_sql = "owner_id IN (SELECT value FROM json_each(:user_ids)) AND item_id = :item_id"
+    with get_db_cursor() as cur:
+        cur.execute(
+            f"SELECT COUNT(*), TOTAL(MIN(quantity, :quantity)) FROM inventory WHERE {owners_sql}",
+            params,
+        )
+        users, removed = cur.fetchone()
+        cur.execute(f"DELETE FROM inventory WHERE {owners_sql} AND quantity <= :quantity", params)
+        cur.execute(f"UPDATE inventory SET quantity = quantity - :quantity WHERE {owners_sql}", params)
+        return users, int(removed)
+
+
+def consume_inventory_item(user_id, item_id: str) -> bool:
+    """Removes a single copy of an item from a user's inventory. Returns False if they had none."""
+    removed, _ = remove_inventory_item(user_id, item_id, 1)
+    return removed
+
+
+def grant_random_prize(user_id):
+    """
+    Gives a random shop item to a user and resets their prize timestamp.
+    Returns the won item, or None if there is nothing to win.
+    """
+    # Read once: a catalogue refresh may replace the sampler meanwhile
+    sampler = _prize_sampler
+    if sampler is None:
+        return None
+
+    item_details = sampler.pick()
+    with get_db_cursor() as cur:
+        _add_inventory_item(cur, user_id, item_details["item_id"], 1)
+        cur.execute(
+            "UPDATE pets SET last_prize_ts = ? WHERE user_id = ?",
+            (int(time.time()), user_id),
+        )
+        return item_details
+
+
+def _invalidate_leaderboard(def_id=None, owner_id=None, new_value=None):
+    """
+    Drops cached leaderboards. With a def_id, only that stat's board is dropped,
+    and with an owner_id only if the owner's new value could change its cached top entries.
+    Call it after the change is committed.
+    """
+    global _leaderboard_generation
+    with _leaderboard_lock:
+        # Bumped even when nothing is cached here: a cluster's writer process never caches a board,
+        # and the generation is how it tells the workers that theirs may be stale
+        _leaderboard_generation += 1
+        if def_id is None:
+            _leaderboard_cache.clear()
+            return
+        if owner_id is None:
+            _leaderboard_cache.pop(def_id, None)
+            return
+
+        cached = _leaderboard_cache.get(def_id)
+        if not cached:
+            return
+        entries = cached[1]
+        if (
+            len(entries) < LEADERBOARD_CACHE_SIZE
+            or new_value >= entries[-1]["stat_value"]
+            or any(entry["owner_id"] == owner_id for entry in entries)
+        ):
+            del _leaderboard_cache[def_id]
+
+
+def fetch_leaderboard(stat_name: str, limit: int = 10, after: dict | None = None, offset: int = 0):
+    """
+    Fetches the pets with the highest value for a stat, as {rank, owner_id, name, stat_value} dicts.
+    Pages are chained by keyset: pass the last entry of the previous page as 'after'
+    (and optionally skip 'offset' more entries past it).
+    Returns None if the stat doesn't exist.
+    """
+    definition = get_stat_definition(stat_name)
+    if not definition:
+        return None
+
+    params = {
+        "def_id": definition["def_id"],
+        "limit": limit,
+        "offset": offset,
+        "now": int(time.time()),
+        "tick": DECAY_TICK_SECONDS,
+        "decay": definition["decay_amount"],
+    }
+    if definition["decay_amount"] and definition["decay_amount"] > 0:
+        # Rank decaying stats by their value with pending decay applied. This can't use the index,
+        # which is what the cached top entries are for.
+        value_sql = f"MAX(0, ps.stat_value - :decay * ((:now - {_LAST_DECAY_SQL}) / :tick))"
+    else:
+        value_sql = "ps.stat_value"
+
+    keyset_sql = ""
+    first_rank = offset + 1
+    if after:
+        keyset_sql = f"AND ({value_sql}, ps.owner_id) < (:after_value, :after_owner)"
+        params["after_value"] = after["stat_value"]
+        params["after_owner"] = after["owner_id"]
+        first_rank += after["rank"]
+
+    with get_db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT ps.owner_id, p.name, {value_sql} AS stat_value
             FROM pet_stats ps
-            JOIN stat_definitions sd ON ps.def_id = sd.def_id
-            WHERE ps.owner_id = ? AND ps.def_id = ?
+            JOIN pets p ON p.user_id = ps.owner_id
+            WHERE ps.def_id = :def_id {keyset_sql}
+            ORDER BY stat_value DESC, ps.owner_id DESC
+            LIMIT :limit OFFSET :offset
         """,
-            (user_id, def_id),
+            params,
         )
-        current = cur.fetchone()
-        if not current:
-            return None
+        return [
+            {"rank": rank, **dict(row)}
+            for rank, row in enumerate(cur.fetchall(), start=first_rank)
+        ]
+
+
+def fetch_leaderboard_page(stat_name: str, page: int = 1, page_size: int = 10):
+    """
+    Fetches one page of a stat's leaderboard, see fetch_leaderboard().
+    Pages within the top LEADERBOARD_CACHE_SIZE entries are served from memory.
+    """
+    definition = get_stat_definition(stat_name)
+    if not definition:
+        return None
+    def_id = definition["def_id"]
+    now = datetime.datetime.now()
+
+    with _leaderboard_lock:
+        cached = _leaderboard_cache.get(def_id)
+        generation = _leaderboard_generation
+    if cached and now - cached[0] < LEADERBOARD_CACHE_TTL:
+        top_entries = cached[1]
+    else:
+        top_entries = fetch_leaderboard(stat_name, LEADERBOARD_CACHE_SIZE)
+        with _leaderboard_lock:
+            if generation == _leaderboard_generation:
+                _leaderboard_cache[def_id] = (now, top_entries)
+
+    start = (page - 1) * page_size
+    if start + page_size <= len(top_entries) or len(top_entries) < LEADERBOARD_CACHE_SIZE:
+        return top_entries[start : start + page_size]
 
-        new_value = 0
-        cap = current["cap"]
+    # Past the cached entries, continue from the last one instead of scanning from the top
+    return fetch_leaderboard(
+        stat_name,
+        page_size,
+        after=top_entries[-1],
+        offset=max(0, start - len(top_entries)),
+    )
 
-        if mode == "add":
-            new_value = current["stat_value"] + amount
-            # If there is a cap, apply it. Otherwise, let the value be whatever it is.
-            if cap is not None:
-                new_value = max(0, min(cap, new_value))
-        elif mode == "set":
-            new_value = amount
-            if cap is not None:
-                new_value = max(0, min(cap, new_value))
 
+def upsert_shop_item(item_id, name, price, description, effect_stat, effect_value, is_visible):
+    """Adds or replaces a shop item. An existing item keeps its place in the prize drop table."""
+    with get_db_cursor() as cur:
         cur.execute(
-            "UPDATE pet_stats SET stat_value = ?, last_updated = ? WHERE owner_id = ? AND def_id = ?",
-            (new_value, datetime.datetime.now().isoformat(), user_id, def_id),
+            """
+            INSERT INTO shop (item_id, name, price, description, effect_stat, effect_value, is_visible)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (item_id) DO UPDATE SET
+                name = excluded.name,
+                price = excluded.price,
+                description = excluded.description,
+                effect_stat = excluded.effect_stat,
+                effect_value = excluded.effect_value,
+                is_visible = excluded.is_visible
+        """,
+            (item_id, name, price, description, effect_stat, effect_value, is_visible),
         )
-        return new_value
 
+    refresh_shop_catalogue()
 
-def fetch_all_shop_items():
-    """Fetches all items from the shop table."""
+
+def set_prize_weight(item_id: str, weight: int, tier: str | None = None) -> bool:
+    """
+    Sets how likely an item is to be won within its prize tier (0 to never give it as a prize),
+    and optionally moves it to another tier. Returns False if the item doesn't exist.
+    """
     with get_db_cursor() as cur:
-        cur.execute("SELECT * FROM shop ORDER BY price ASC")
+        cur.execute(
+            "UPDATE shop SET prize_weight = ?, prize_tier = COALESCE(?, prize_tier) WHERE item_id = ?",
+            (weight, tier, item_id),
+        )
+        updated = cur.rowcount > 0
+
+    refresh_shop_catalogue()
+    return updated
+
+
+def upsert_prize_tier(tier: str, weight: int, display_name: str | None = None):
+    """Adds a prize rarity tier or changes its weight (0 to give none of its items as prizes)."""
+    with get_db_cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO prize_tiers (tier, weight, display_name) VALUES (?, ?, COALESCE(?, ?))
+            ON CONFLICT (tier) DO UPDATE SET
+                weight = excluded.weight,
+                display_name = COALESCE(?, display_name)
+        """,
+            (tier, weight, display_name, tier.capitalize(), display_name),
+        )
+
+    refresh_shop_catalogue()
+
+
+def delete_shop_item(item_id: str) -> bool:
+    """Deletes a shop item. Returns False if it didn't exist."""
+    with get_db_cursor() as cur:
+        cur.execute("DELETE FROM shop WHERE item_id = ?", (item_id,))
+        deleted = cur.rowcount > 0
+
+    refresh_shop_catalogue()
+    return deleted
+
+
+def upsert_stat_definition(stat_name, default, cap, cooldown, decay, display_name) -> int:
+    """
+    Adds a stat definition, or updates it in place if the stat exists (keeping its def_id).
+    Returns the def_id. Existing pets get the stat through backfill_stat().
+    """
+    # Buffered pets were loaded without the new stat, make them reload it
+    flush_stat_buffer()
+    with get_db_cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO stat_definitions (stat_name, default_value, cap, cooldown_seconds, decay_amount, display_name)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (stat_name) DO UPDATE SET
+                default_value = excluded.default_value,
+                cap = excluded.cap,
+                cooldown_seconds = excluded.cooldown_seconds,
+                decay_amount = excluded.decay_amount,
+                display_name = excluded.display_name
+            RETURNING def_id
+        """,
+            (stat_name, default, cap, cooldown, decay, display_name),
+        )
+        def_id = cur.fetchone()["def_id"]
+
+    refresh_stat_definitions()
+    _invalidate_leaderboard()
+    return def_id
+
+
+# Pets given a new stat per transaction by backfill_stat()
+STAT_BACKFILL_CHUNK = 5000
+
+
+def backfill_stat(def_id: int, default: int, after_user_id: int = 0, chunk_size: int = STAT_BACKFILL_CHUNK):
+    """
+    Gives a stat, at its default value, to the next 'chunk_size' pets after 'after_user_id' that lack it.
+    Call it again with the returned user id until that is None, so no single transaction holds
+    the write lock for long. Returns (number of pets the stat was added to, last user id of the chunk).
+    """
+    with get_db_cursor() as cur:
+        cur.execute(
+            "SELECT MAX(user_id) FROM (SELECT user_id FROM pets WHERE user_id > ? ORDER BY user_id LIMIT ?)",
+            (after_user_id, chunk_size),
+        )
+        last_user_id = cur.fetchone()[0]
+        if last_user_id is None:
+            return 0, None
+
+        cur.execute(
+            """
+            INSERT INTO pet_stats (owner_id, def_id, stat_value)
+            SELECT p.user_id, :def_id, :default
+            FROM pets p
+            WHERE p.user_id > :after AND p.user_id <= :last
+                AND NOT EXISTS (
+                    SELECT 1 FROM pet_stats ps WHERE ps.owner_id = p.user_id AND ps.def_id = :def_id
+                )
+        """,
+            {"def_id": def_id, "default": default, "after": after_user_id, "last": last_user_id},
+        )
+        added = cur.rowcount
+
+    if added:
+        _invalidate_leaderboard()
+    return added, last_user_id
+
+
+def count_pets() -> int:
+    with get_db_cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM pets")
+        return cur.fetchone()[0]
+
+
+def delete_stat_definition(stat_name: str) -> bool:
+    """Deletes a stat definition, the shop items that target it and (by cascade) every pet's copy of it."""
+    flush_stat_buffer()
+    with get_db_cursor() as cur:
+        cur.execute("DELETE FROM stat_definitions WHERE stat_name = ?", (stat_name,))
+        deleted = cur.rowcount > 0
+        cur.execute("DELETE FROM shop WHERE effect_stat = ?", (stat_name,))
+
+    refresh_stat_definitions()
+    refresh_shop_catalogue()
+    _invalidate_leaderboard()
+    return deleted
+
+
+def _delete_runaway_pets(cur, pets, now: int):
+    """Deletes pets (owner_id, name rows) with their stats and inventories, and queues a DM to each owner."""
+    owner_ids = json.dumps([pet["owner_id"] for pet in pets])
+    # One statement per table
+    for table, column in (
+        ("pets", "user_id"),
+        ("pet_stats", "owner_id"),
+        ("inventory", "owner_id"),
+    ):
+        cur.execute(
+            f"DELETE FROM {table} WHERE {column} IN (SELECT value FROM json_each(?))",
+            (owner_ids,),
+        )
+
+    # The DMs are sent once the caller's transaction has committed
+    cur.executemany(
+        "INSERT INTO notification_outbox (user_id, message, next_attempt_at) VALUES (?, ?, ?)",
+        [(pet["owner_id"], RUNAWAY_MESSAGE.format(pet_name=pet["name"]), now) for pet in pets],
+    )
+
+
+def remove_runaway_pets():
+    """
+    Deletes every pet whose willpower has been drained by neglect, including decay that is still pending,
+    and queues a DM to each owner in the notification outbox.
+    Returns the (owner_id, name) rows of the deleted pets, or None if the willpower stat is missing.
+    """
+    willpower_id = get_stat_definition_id("willpower")
+    if not willpower_id:
+        return None
+
+    # The check (and the deletes) must see the buffered changes
+    flush_stat_buffer()
+
+    now = int(time.time())
+    with get_db_cursor() as cur:
+        # Step 1: Find the pets that could have run away. A pet loses at most
+        # NEGLECT_WILLPOWER_PENALTY willpower per tick, so any pet cared for recently
+        # enough is ruled out without looking at the rest of its stats.
+        cur.execute(
+            f"""
+            SELECT p.user_id AS owner_id, p.name, {_LAST_DECAY_SQL} AS last_decay
+            FROM pets p
+            JOIN pet_stats ps ON ps.owner_id = p.user_id AND ps.def_id = ?
+            WHERE ((? - {_LAST_DECAY_SQL}) / ?) * ? >= ps.stat_value
+        """,
+            (
+                willpower_id,
+                now,
+                DECAY_TICK_SECONDS,
+                NEGLECT_WILLPOWER_PENALTY,
+            ),
+        )
+        candidates = cur.fetchall()
+
+        # Step 2: Work out their pending decay to see which ones actually ran away,
+        # with all of their stats fetched in one query
+        cur.execute(
+            "SELECT owner_id, def_id, stat_value FROM pet_stats WHERE owner_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([pet["owner_id"] for pet in candidates]),),
+        )
+        values_by_owner = {}
+        for stat in cur.fetchall():
+            values_by_owner.setdefault(stat["owner_id"], {})[stat["def_id"]] = stat["stat_value"]
+
+        pets_to_remove = []
+        for pet in candidates:
+            ticks = _pending_decay_ticks(_epoch(pet["last_decay"]), now)
+            if _has_run_away(_apply_decay_ticks(values_by_owner.get(pet["owner_id"], {}), ticks)):
+                pets_to_remove.append(pet)
+
+        # Step 3: Delete them and queue their owners' DMs
+        if pets_to_remove:
+            _delete_runaway_pets(cur, pets_to_remove, now)
+
+    if pets_to_remove:
+        _invalidate_leaderboard()
+    return pets_to_remove
+
+
+def claim_due_notifications(limit: int = 50):
+    """
+    Claims up to 'limit' notifications that are due for delivery and counts the attempt.
+    Notifications that already used up their attempts are dropped instead.
+    A claimed notification isn't handed out again until NOTIFICATION_RETRY_DELAY has passed,
+    so the caller must delete it with complete_notifications() once it is delivered.
+    """
+    now = int(time.time())
+    with get_db_cursor() as cur:
+        cur.execute(
+            "DELETE FROM notification_outbox WHERE attempts >= ? AND next_attempt_at <= ?",
+            (NOTIFICATION_MAX_ATTEMPTS, now),
+        )
+        cur.execute(
+            """
+            UPDATE notification_outbox
+            SET attempts = attempts + 1, next_attempt_at = ?
+            WHERE notification_id IN (
+                SELECT notification_id FROM notification_outbox
+                WHERE next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT ?
+            )
+            RETURNING notification_id, user_id, message, attempts
+        """,
+            (now + int(NOTIFICATION_RETRY_DELAY.total_seconds()), now, limit),
+        )
         return cur.fetchall()
 
 
-def fetch_shop_item(item_id: str):
-    """Fetches a single item from the shop table."""
+def complete_notifications(notification_ids):
+    """Removes delivered (or undeliverable) notifications from the outbox."""
     with get_db_cursor() as cur:
-        cur.execute("SELECT * FROM shop WHERE item_id = ?", (item_id,))
-        return cur.fetchone()
+        cur.execute(
+            "DELETE FROM notification_outbox WHERE notification_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(notification_ids)),),
+        )
+
+
+def get_cache_versions():
+    """Returns the versions of the in-memory caches that a write can make stale."""
+    return (_stat_registry_version, _shop_catalogue_version, _leaderboard_generation, _hatch_generation)
+
+
+def set_remote_writer(remote_writer):
+    """Sends every write to another process from now on, see _remote_writer."""
+    global _remote_writer, _remote_cache_versions
+    _remote_writer = remote_writer
+    _remote_cache_versions = None
+
+
+def _sync_remote_caches(versions):
+    """Reloads the caches the writer process changed since we last heard from it."""
+    global _remote_cache_versions
+    previous = _remote_cache_versions or (None, None, None, None)
+    _remote_cache_versions = versions
+    if versions[0] != previous[0]:
+        refresh_stat_definitions()
+    if versions[1] != previous[1]:
+        refresh_shop_catalogue()
+    if versions[2] != previous[2]:
+        _invalidate_leaderboard()
+    if previous[3] is not None and versions[3] != previous[3]:
+        # Pets hatched through any worker: drop the cooldowns this one recorded for their previous pets
+        hatched, _ = _remote_writer("users_hatched_since", (previous[3],), {})
+        if hatched is None:
+            cooldowns.clear()
+        else:
+            for user_id in hatched:
+                cooldowns.forget(user_id)
+
+
+def sync_with_remote_writer():
+    """Picks up cache changes from the writer process even when this process hasn't written anything."""
+    if _remote_writer is not None:
+        _db_write_executor.submit(_run_write, get_cache_versions, (), {}).result()
+
+
+def _run_write(func, args, kwargs):
+    if _remote_writer is None:
+        return func(*args, **kwargs)
+    result, versions = _remote_writer(func.__name__, args, kwargs)
+    _sync_remote_caches(versions)
+    return result
+
+
+def run_in_db_thread(func, readonly=False):
+    """
+    Turns a blocking database function into a coroutine that runs it on a database thread.
+    Read-only functions go to the reader pool, everything else to the single writer thread
+    (which hands it to the writer process in a cluster worker).
+    """
+    executor = _db_read_executor if readonly else _db_write_executor
+    if not readonly:
+        WRITE_FUNCTIONS[func.__name__] = func
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if readonly:
+            job = functools.partial(func, *args, **kwargs)
+        else:
+            job = functools.partial(_run_write, func, args, kwargs)
+        return await loop.run_in_executor(executor, job)
+
+    return wrapper
+
+
+def shutdown_db_threads():
+    """Waits for pending database work, then lets the worker threads (and their connections) go."""
+    _shutting_down.set()
+    _db_write_executor.submit(flush_stat_buffer).add_done_callback(_report_flush_failure)
+    _db_write_executor.shutdown(wait=True)
+    _db_read_executor.shutdown(wait=True)
+    close_connection()
+
+
+# Awaitable equivalents of the functions above. Coroutines (i.e. every cog) must use these.
+# The stat registry and shop catalogue getters are pure in-memory lookups and can be called directly.
+fetch_pet_async = run_in_db_thread(fetch_pet, readonly=True)
+modify_pet_stat_async = run_in_db_thread(modify_pet_stat)
+modify_pet_stats_async = run_in_db_thread(modify_pet_stats)
+modify_stats_for_pets_async = run_in_db_thread(modify_stats_for_pets)
+create_pet_async = run_in_db_thread(create_pet)
+rename_pet_async = run_in_db_thread(rename_pet)
+fetch_inventory_async = run_in_db_thread(fetch_inventory, readonly=True)
+add_inventory_item_async = run_in_db_thread(add_inventory_item)
+remove_inventory_item_async = run_in_db_thread(remove_inventory_item)
+purchase_item_async = run_in_db_thread(purchase_item)
+add_inventory_item_for_pets_async = run_in_db_thread(add_inventory_item_for_pets)
+remove_inventory_item_for_users_async = run_in_db_thread(remove_inventory_item_for_users)
+consume_inventory_item_async = run_in_db_thread(consume_inventory_item)
+grant_random_prize_async = run_in_db_thread(grant_random_prize)
+fetch_leaderboard_page_async = run_in_db_thread(fetch_leaderboard_page, readonly=True)
+upsert_shop_item_async = run_in_db_thread(upsert_shop_item)
+delete_shop_item_async = run_in_db_thread(delete_shop_item)
+set_prize_weight_async = run_in_db_thread(set_prize_weight)
+upsert_prize_tier_async = run_in_db_thread(upsert_prize_tier)
+upsert_stat_definition_async = run_in_db_thread(upsert_stat_definition)
+backfill_stat_async = run_in_db_thread(backfill_stat)
+count_pets_async = run_in_db_thread(count_pets, readonly=True)
+delete_stat_definition_async = run_in_db_thread(delete_stat_definition)
+remove_runaway_pets_async = run_in_db_thread(remove_runaway_pets)
+claim_due_notifications_async = run_in_db_thread(claim_due_notifications)
+complete_notifications_async = run_in_db_thread(complete_notifications)
@@ -0,0 +1,150 @@
+# launcher.py
+"""
+Runs the bot as a cluster: one database writer process plus several bot processes
+("workers"), each connecting its own share of the gateway shards, so the bot can use
+more than one CPU core. Workers read the database directly and send every write to the
+writer over a Unix socket, see writer_service.py.
+
+Usage:
+    python launcher.py --workers 4 --shards 16
+"""
+import argparse
+import multiprocessing
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+import writer_service
+
+# A worker that crashes is started again after this many seconds
+WORKER_RESTART_DELAY = 5
+# How long workers get to log out and finish their writes when the cluster stops
+WORKER_STOP_TIMEOUT = 30
+
+
+def assign_shards(shard_count: int, worker_count: int) -> list[list[int]]:
+    """Splits the shard ids into 'worker_count' contiguous, evenly sized groups."""
+    return [
+        list(range(shard_count * i // worker_count, shard_count * (i + 1) // worker_count))
+        for i in range(worker_count)
+    ]
+
+
+def start_worker(index: int, shard_ids: list[int], shard_count: int, address: str, authkey: bytes):
+    """Starts main.py for one worker with its shards and the writer's address in its environment."""
+    env = dict(
+        os.environ,
+        SHARD_COUNT=str(shard_count),
+        SHARD_IDS=",".join(map(str, shard_ids)),
+        WRITER_SOCKET=address,
+        WRITER_AUTHKEY=authkey.hex(),
+    )
+    metrics_port = int(os.getenv("METRICS_PORT", "0"))
+    if metrics_port:
+        # Every worker gets its own port, starting from METRICS_PORT
+        env["METRICS_PORT"] = str(metrics_port + index)
+
+    print(f"Starting worker {index} with shards {shard_ids}")
+    return subprocess.Popen([sys.executable, "main.py"], env=env)
+
+
+def stop_workers(workers: dict[int, subprocess.Popen]):
+    # SIGINT is the Ctrl+C discord.py already handles by logging out cleanly
+    for process in workers.values():
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+    deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+    for process in workers.values():
+        try:
+            process.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--workers", type=int, default=int(os.getenv("CLUSTER_WORKERS", os.cpu_count() or 1))
+    )
+    parser.add_argument(
+        "--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")),
+        help="Total gateway shards, defaults to one per worker",
+    )
+    parser.add_argument("--socket", default=os.getenv("WRITER_SOCKET", "pawder-writer.sock"))
+    args = parser.parse_args()
+
+    worker_count = max(1, args.workers)
+    shard_count = max(args.shards, worker_count)
+    address = os.path.abspath(args.socket)
+    # Only processes started by this launcher can connect to the writer
+    authkey = secrets.token_bytes(32)
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    writer = context.Process(
+        target=writer_service.serve, args=(address, authkey, ready), name="pawder-writer"
+    )
+    writer.start()
+    try:
+        while not ready.wait(1):
+            if not writer.is_alive():
+                raise RuntimeError("The database writer failed to start.")
+    except KeyboardInterrupt:
+        writer.terminate()
+        raise
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    shard_groups = assign_shards(shard_count, worker_count)
+    workers = {
+        index: start_worker(index, shard_ids, shard_count, address, authkey)
+        for index, shard_ids in enumerate(shard_groups)
+    }
+    restart_at: dict[int, float] = {}
+
+    try:
+        while not stopping:
+            time.sleep(1)
+            if not writer.is_alive():
+                print("The database writer stopped, shutting the cluster down.")
+                break
+
+            for index, process in workers.items():
+                if process.poll() is None or index in restart_at:
+                    continue
+                print(f"Worker {index} exited with code {process.returncode}, restarting it in {WORKER_RESTART_DELAY}s")
+                restart_at[index] = time.monotonic() + WORKER_RESTART_DELAY
+
+            for index, when in list(restart_at.items()):
+                if time.monotonic() >= when:
+                    del restart_at[index]
+                    workers[index] = start_worker(
+                        index, shard_groups[index], shard_count, address, authkey
+                    )
+    finally:
+        print("Stopping the workers...")
+        stop_workers(workers)
+        # The writer goes last, so every write the workers made is committed
+        if writer.is_alive():
+            writer.terminate()
+        writer.join()
+
+    if writer.exitcode:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 # main.py
+import asyncio
+import time
 import traceback
 import discord
 from discord.ext import commands
@@ -6,32 +8,78 @@ import os
 from dotenv import load_dotenv
 
 # Import our database setup function
-from database import setup_database
+from database import setup_database, warm_caches, shutdown_db_threads, enable_stat_write_behind
+from metrics import (
+    command_latency,
+    command_errors,
+    shard_commands,
+    shard_latency,
+    start_metrics_server,
+)
+from stall_watchdog import LoopStallWatchdog
+from backups import configure_backups
+from writer_service import connect_to_writer
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
+# Seconds of stat changes to buffer in memory before writing them out. 0 writes every change immediately.
+STAT_FLUSH_SECONDS = float(os.getenv('STAT_FLUSH_SECONDS', '0'))
+# Local port to serve Prometheus metrics on. 0 disables the endpoint.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Report callbacks that block the event loop for longer than this many milliseconds. 0 disables the watchdog.
+LOOP_WATCHDOG_MS = float(os.getenv('LOOP_WATCHDOG_MS', '0'))
+# Total number of gateway shards. 0 runs a single unsharded connection.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+# Comma separated shard ids this process connects, e.g. "0,1". Empty runs all of them.
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()]
+# In a cluster, the shard whose worker takes the scheduled backups, so they only run once across workers
+JOBS_SHARD_ID = int(os.getenv('JOBS_SHARD_ID', '0'))
+# Set by launcher.py for its workers: every write goes to the cluster's writer process on this socket
+WRITER_SOCKET = os.getenv('WRITER_SOCKET')
+WRITER_AUTHKEY = bytes.fromhex(os.getenv('WRITER_AUTHKEY', ''))
+# Hours between automatic database backups. 0 only backs up on !backup.
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '0'))
+# Directory the backups are written to, and how many of the newest ones are kept there
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+# Set to 1 to gzip the backups
+BACKUP_COMPRESS = os.getenv('BACKUP_COMPRESS', '0') == '1'
+
+# Sharding is opt-in, an unsharded bot keeps using a plain commands.Bot
+BotBase = commands.AutoShardedBot if SHARD_COUNT else commands.Bot
 
 class MyHelpCommand(commands.HelpCommand):
     async def send_bot_help(self, mapping):
-        embed = discord.Embed(
-            title="Pawder Bot Help", 
-            description="Here are all the available commands, grouped by category.",
-            color=discord.Color.blurple()
-        )
-        
+        # Which commands are listed depends on the user's checks, so the filtering runs every time,
+        # but the embed for each resulting set of commands is only built once
+        sections = []
         for cog, cog_commands in mapping.items():
             if cog:
                 filtered_commands = await self.filter_commands(cog_commands)
                 if filtered_commands:
-                    command_signatures = [f"`!{c.name}` - {c.short_doc}" for c in filtered_commands]
-                    embed.add_field(
-                        name=cog.qualified_name,
-                        value="\n".join(command_signatures),
-                        inline=False
-                    )
-
-        embed.set_footer(text="Use !help <command> for more info on a specific command.")
+                    sections.append((cog.qualified_name, tuple(filtered_commands)))
+
+        cache_key = tuple((name, tuple(c.qualified_name for c in cmds)) for name, cmds in sections)
+        embed = self.context.bot.help_embeds.get(cache_key)
+        if embed is None:
+            embed = discord.Embed(
+                title="Pawder Bot Help", 
+                description="Here are all the available commands, grouped by category.",
+                color=discord.Color.blurple()
+            )
+
+            for cog_name, cog_commands in sections:
+                command_signatures = [f"`!{c.name}` - {c.short_doc}" for c in cog_commands]
+                embed.add_field(
+                    name=cog_name,
+                    value="\n".join(command_signatures),
+                    inline=False
+                )
+
+            embed.set_footer(text="Use !help <command> for more info on a specific command.")
+            self.context.bot.help_embeds[cache_key] = embed
+
         await self.get_destination().send(embed=embed)
     
     async def send_command_help(self, command):
@@ -54,12 +102,30 @@ class MyHelpCommand(commands.HelpCommand):
         
         await self.get_destination().send(embed=embed)
 
-class PetBot(commands.Bot):
+class PetBot(BotBase):
     def __init__(self):
         intents = discord.Intents.default()
         intents.message_content = True
         intents.members = True
-        super().__init__(command_prefix='!', intents=intents, help_command=MyHelpCommand())
+        shard_options = {}
+        if SHARD_COUNT:
+            shard_options["shard_count"] = SHARD_COUNT
+            if SHARD_IDS:
+                shard_options["shard_ids"] = SHARD_IDS
+        super().__init__(
+            command_prefix='!', intents=intents, help_command=MyHelpCommand(), **shard_options
+        )
+        # Background jobs that must only run once (e.g. the runaway pet check) run in the writer process of a cluster
+        self.runs_background_jobs = not WRITER_SOCKET
+        # Backups only read the database, so in a cluster the worker owning the jobs shard takes them
+        self.runs_scheduled_backups = not SHARD_COUNT or not SHARD_IDS or JOBS_SHARD_ID in SHARD_IDS
+        self.backup_interval_hours = BACKUP_INTERVAL_HOURS
+        self.metrics_runner = None
+        self.watchdog = None
+        # Rendered !help embeds. The help command is copied for every invocation, so they live here.
+        self.help_embeds: dict[tuple, discord.Embed] = {}
+        self.before_invoke(self.start_command_timer)
+        self.after_invoke(self.record_command_latency)
 
     async def setup_hook(self):
         for filename in os.listdir('./cogs'):
@@ -67,14 +133,75 @@ class PetBot(commands.Bot):
                 await self.load_extension(f'cogs.{filename[:-3]}')
                 print(f"Loaded cog: {filename}")
 
+        if SHARD_COUNT:
+            shard_latency.set_function(
+                lambda: {str(shard_id): latency for shard_id, latency in self.latencies}
+            )
+        else:
+            shard_latency.set_function(lambda: {"0": self.latency})
+
+        if METRICS_PORT:
+            self.metrics_runner = await start_metrics_server(METRICS_PORT)
+            print(f"Serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+
+        if LOOP_WATCHDOG_MS > 0:
+            self.watchdog = LoopStallWatchdog(LOOP_WATCHDOG_MS / 1000).start()
+            print(f"Watching for event loop stalls over {LOOP_WATCHDOG_MS:g}ms")
+
+    async def add_cog(self, cog, *args, **kwargs):
+        self.help_embeds.clear()
+        await super().add_cog(cog, *args, **kwargs)
+
+    async def remove_cog(self, name, *args, **kwargs):
+        self.help_embeds.clear()
+        return await super().remove_cog(name, *args, **kwargs)
+
+    async def start_command_timer(self, ctx: commands.Context):
+        ctx.started_at = time.perf_counter()
+
+    async def record_command_latency(self, ctx: commands.Context):
+        started_at = getattr(ctx, "started_at", None)
+        if started_at is not None and ctx.command:
+            command_latency.observe(ctx.command.qualified_name, time.perf_counter() - started_at)
+        # Direct messages always arrive on shard 0
+        shard_commands.inc(str(ctx.guild.shard_id if ctx.guild else 0))
+
+    async def close(self):
+        if self.watchdog:
+            self.watchdog.stop()
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        await super().close()
+        # Let queued writes finish before the process exits
+        await asyncio.to_thread(shutdown_db_threads)
+
     async def on_ready(self):
         if not self.user:
             raise RuntimeError("Failed to log in. Shutting down...")
         print(f'Logged in as {self.user.name}')
         print(f'Bot is ready and running in {len(self.guilds)} servers.')
+        if SHARD_COUNT:
+            print(f'Running shards {sorted(self.shards)} of {self.shard_count}.')
         print('--------------------------------')
+
+    async def on_shard_ready(self, shard_id: int):
+        guild_count = sum(1 for guild in self.guilds if guild.shard_id == shard_id)
+        print(f'Shard {shard_id} is ready with {guild_count} servers.')
+
+    async def on_shard_connect(self, shard_id: int):
+        print(f'Shard {shard_id} connected to the gateway.')
+
+    async def on_shard_disconnect(self, shard_id: int):
+        print(f'Shard {shard_id} disconnected from the gateway.')
+
+    async def on_shard_resumed(self, shard_id: int):
+        print(f'Shard {shard_id} resumed its session.')
         
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
+        # Errors raised by the command itself come wrapped, count them by their real type
+        original = getattr(error, "original", error)
+        command_errors.inc(type(original).__name__)
+
         embed = discord.Embed(title="Error")
         if isinstance(error, commands.MissingRequiredArgument):
             embed.title = ":x: Error: missing required argument"
@@ -90,8 +217,20 @@ class PetBot(commands.Bot):
             print(f"An unhandled error occurred: {error}")
         await ctx.send(embed=embed)
 
+if SHARD_IDS and not WRITER_SOCKET:
+    # Separate processes on one database would each keep their own caches (and write-behind buffer)
+    # with nothing telling them about the others' writes
+    raise RuntimeError("SHARD_IDS only works for the workers of launcher.py, use it to split shards across processes.")
 bot = PetBot()
-setup_database()
+configure_backups(BACKUP_DIR, BACKUP_KEEP, BACKUP_COMPRESS)
+if WRITER_SOCKET:
+    # The writer process set up the database, and buffering writes is its business
+    warm_caches()
+    connect_to_writer(WRITER_SOCKET, WRITER_AUTHKEY)
+else:
+    setup_database()
+    if STAT_FLUSH_SECONDS > 0:
+        enable_stat_write_behind(STAT_FLUSH_SECONDS)
 if not TOKEN:
     raise RuntimeError("Please provide a valid discord bot token")
 bot.run(TOKEN)
\ No newline at end of file
@@ -0,0 +1,220 @@
+# metrics.py
+import bisect
+import collections
+import datetime
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets, Prometheus-style
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# SQL statements slower than this are kept in the slow query log
+SLOW_QUERY_THRESHOLD = 0.05
+SLOW_QUERY_LOG_SIZE = 50
+
+
+class Histogram:
+    """A set of latency histograms, one per label value (e.g. per command)."""
+
+    def __init__(self, name: str, description: str, label: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        # label value -> [bucket counts..., +Inf count], sum
+        self._counts: dict[str, list[int]] = {}
+        self._sums: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts = self._counts.setdefault(label_value, [0] * (len(self.buckets) + 1))
+            counts[index] += 1
+            self._sums[label_value] = self._sums.get(label_value, 0.0) + seconds
+
+    def snapshot(self):
+        """Returns {label value: (bucket counts, sum)}."""
+        with self._lock:
+            return {
+                label_value: (list(counts), self._sums[label_value])
+                for label_value, counts in self._counts.items()
+            }
+
+    def quantile(self, label_value: str, q: float):
+        """Estimates a quantile as the upper bound of the bucket it falls in."""
+        counts, _ = self.snapshot().get(label_value, (None, None))
+        if not counts:
+            return None
+        target = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        """Renders the histogram in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total) in sorted(self.snapshot().items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    """A set of counters, one per label value."""
+
+    def __init__(self, name: str, description: str, label: str):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._values: collections.Counter[str] = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: int = 1):
+        with self._lock:
+            self._values[label_value] += amount
+
+    def snapshot(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self.snapshot().items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {value}')
+        return lines
+
+
+class Gauge:
+    """A set of gauges, one per label value, read from a callback when the metrics are rendered."""
+
+    def __init__(self, name: str, description: str, label: str):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._collect = None
+
+    def set_function(self, collect):
+        """Sets the callback that returns {label value: current value}."""
+        self._collect = collect
+
+    def snapshot(self) -> dict[str, float]:
+        return dict(self._collect()) if self._collect else {}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for label_value, value in sorted(self.snapshot().items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {value}')
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+command_latency = Histogram(
+    "pawder_command_duration_seconds", "Time taken to run a command.", "command"
+)
+command_errors = Counter(
+    "pawder_command_errors_total", "Commands that raised an error, by error type.", "error"
+)
+query_latency = Histogram(
+    "pawder_query_duration_seconds", "Time taken to execute a SQL statement, by statement type.", "statement"
+)
+shard_commands = Counter(
+    "pawder_shard_commands_total", "Commands handled, by gateway shard.", "shard"
+)
+shard_latency = Gauge(
+    "pawder_shard_latency_seconds", "Gateway heartbeat latency, by shard.", "shard"
+)
+event_loop_lag = Histogram(
+    "pawder_event_loop_lag_seconds", "How late the event loop ran a scheduled wakeup.", "loop"
+)
+event_loop_stalls = Counter(
+    "pawder_event_loop_stalls_total", "Times a callback blocked the event loop past the watchdog threshold.", "loop"
+)
+
+# (when, seconds, sql) of the most recent slow statements
+slow_queries: collections.deque[tuple[datetime.datetime, float, str]] = collections.deque(
+    maxlen=SLOW_QUERY_LOG_SIZE
+)
+
+
+def record_query(sql: str, seconds: float):
+    """Records the execution time of one SQL statement."""
+    statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+    query_latency.observe(statement, seconds)
+    if seconds >= SLOW_QUERY_THRESHOLD:
+        slow_queries.append((datetime.datetime.now(), seconds, " ".join(sql.split())))
+
+
+class TimedCursor:
+    """Wraps a sqlite3 cursor to record how long each execute()/executemany() takes."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, *args)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, *args):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, *args)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+def render_prometheus() -> str:
+    """Renders every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in (
+        command_latency,
+        command_errors,
+        query_latency,
+        shard_commands,
+        shard_latency,
+        event_loop_lag,
+        event_loop_stalls,
+    ):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """Serves /metrics over HTTP on the local interface. Returns the runner, call cleanup() on it to stop."""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(
+            text=render_prometheus(), content_type="text/plain", charset="utf-8"
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,107 @@
+# stall_watchdog.py
+import asyncio
+import collections
+import sys
+import threading
+import time
+import traceback
+
+from metrics import event_loop_lag, event_loop_stalls
+
+# At most this many stall reports are printed per minute, the rest are only counted
+MAX_REPORTS_PER_MINUTE = 5
+
+
+class LoopStallWatchdog:
+    """
+    Detects callbacks that block the event loop for longer than 'threshold' seconds.
+
+    A coroutine on the loop records a heartbeat several times per threshold. A monitor thread
+    watches it, and when it stops for too long the loop thread is stuck in a blocking call:
+    the monitor then captures that thread's Python stack (and the command it is running,
+    if any) while it is still blocked, and prints it.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self._last_beat = time.monotonic()
+        self._stop = threading.Event()
+        self._report_times = collections.deque()
+        self._suppressed = 0
+        self._loop_thread_id = None
+        self._heartbeat_task = None
+        self._thread = None
+
+    def start(self):
+        """Starts watching the running loop. Must be called from the loop's thread (e.g. in setup_hook)."""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._heartbeat_task = loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(
+            target=self._monitor, name="pawder-loop-watchdog", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            # How late the loop woke us up is how long something else kept it busy
+            event_loop_lag.observe("main", max(0.0, now - expected))
+            self._last_beat = now
+
+    def _monitor(self):
+        reported_beat = None
+        while not self._stop.wait(self.interval):
+            last_beat = self._last_beat
+            stalled_for = time.monotonic() - last_beat - self.interval
+            if stalled_for < self.threshold or last_beat == reported_beat:
+                continue
+
+            # Only report each stall once, however long it lasts
+            reported_beat = last_beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                self._report(stalled_for, frame)
+
+    @staticmethod
+    def _find_command(frame):
+        """Returns the name of the command whose code is on the stack, if any."""
+        while frame is not None:
+            ctx = frame.f_locals.get("ctx")
+            command = getattr(ctx, "command", None)
+            if command is not None:
+                return getattr(command, "qualified_name", str(command))
+            frame = frame.f_back
+        return None
+
+    def _report(self, stalled_for: float, frame):
+        event_loop_stalls.inc("main")
+
+        now = time.monotonic()
+        while self._report_times and now - self._report_times[0] > 60:
+            self._report_times.popleft()
+        if len(self._report_times) >= MAX_REPORTS_PER_MINUTE:
+            self._suppressed += 1
+            return
+        self._report_times.append(now)
+
+        command = self._find_command(frame)
+        stack = "".join(traceback.format_stack(frame))
+        suppressed = (
+            f" ({self._suppressed} more stalls were not reported)" if self._suppressed else ""
+        )
+        self._suppressed = 0
+        print(
+            f"Event loop blocked for {stalled_for * 1000:.0f}ms+"
+            f"{f' while running !{command}' if command else ''}{suppressed}. Loop thread stack:\n{stack}"
+        )
@@ -1,48 +1,215 @@
 import datetime
+import random
+import threading
+import time
 from typing import Any
 
 
+class StatLayout:
+    """
+    The order in which pets store their stat values: one slot per stat definition.
+    A new layout is built whenever the stat registry changes (e.g. after !addstat),
+    pets keep the layout they were fetched with.
+    """
+
+    __slots__ = ("definitions", "by_name", "by_def_id")
+
+    def __init__(self, definitions):
+        self.definitions: tuple[dict[str, Any], ...] = tuple(definitions)
+        self.by_name = {d["stat_name"]: i for i, d in enumerate(self.definitions)}
+        self.by_def_id = {d["def_id"]: i for i, d in enumerate(self.definitions)}
+
+
 class Pet:
-    name: str
-    born_at: datetime.datetime
-    last_prize: datetime.datetime
-    
-    _stats: dict[Any, Any]
-
-    def __init__(self, pet_data: dict[Any, Any]):
-        self.name = pet_data["name"]
-        self.born_at = datetime.datetime.fromisoformat(pet_data["born_at"])
-        
-        if not pet_data["last_prize"]:
-            # get January 1, 1970'd
-            self.last_prize = datetime.datetime.fromtimestamp(0)
-        else:
-            self.last_prize = datetime.datetime.fromisoformat(pet_data["last_prize"])
-        
-        self._stats= pet_data["stats"]
-    
+    """
+    A pet and its stats. Stat values live in a list ordered by the stat layout, and the
+    timestamps are only parsed when they are first used.
+    """
+
+    __slots__ = ("name", "_born_at", "_last_prize", "_layout", "_values", "_last_updated")
+
+    def __init__(self, name: str, born_at, last_prize, layout: StatLayout, values: list, last_updated: list):
+        self.name = name
+        self._born_at = born_at
+        self._last_prize = last_prize
+        self._layout = layout
+        # None for the stats this pet doesn't have
+        self._values = values
+        self._last_updated = last_updated
+
+    @staticmethod
+    def _to_datetime(value) -> datetime.datetime:
+        # Epoch seconds, or ISO-8601 text for rows the timestamp migration hasn't converted yet
+        if isinstance(value, int):
+            return datetime.datetime.fromtimestamp(value)
+        return datetime.datetime.fromisoformat(value)
+
+    @property
+    def born_at(self) -> datetime.datetime:
+        if not isinstance(self._born_at, datetime.datetime):
+            self._born_at = self._to_datetime(self._born_at)
+        return self._born_at
+
+    @property
+    def last_prize(self) -> datetime.datetime:
+        if not isinstance(self._last_prize, datetime.datetime):
+            if not self._last_prize:
+                # get January 1, 1970'd
+                self._last_prize = datetime.datetime.fromtimestamp(0)
+            else:
+                self._last_prize = self._to_datetime(self._last_prize)
+        return self._last_prize
+
+    def has_stat(self, name) -> bool:
+        index = self._layout.by_name.get(name)
+        return index is not None and self._values[index] is not None
+
     def get_stat(self, name):
-        return self._stats[name]
-    
+        """Returns a stat joined with its definition, as a dict."""
+        index = self._layout.by_name[name]
+        definition = self._layout.definitions[index]
+        return {
+            "stat_name": name,
+            "stat_value": self._values[index],
+            "cap": definition["cap"],
+            "last_updated": self._last_updated[index],
+            "cooldown_seconds": definition["cooldown_seconds"],
+            "display_name": definition["display_name"],
+        }
+
     def get_stat_value(self, name) -> int:
-        return self._stats[name]["stat_value"]
-    
+        return self._values[self._layout.by_name[name]]
+
+    def get_stat_last_updated(self, name) -> int | None:
+        """Returns when a stat was last restored, in Unix epoch seconds."""
+        return self._last_updated[self._layout.by_name[name]]
+
+    def stats(self):
+        """Yields (stat definition, value) for every stat the pet has, in registry order."""
+        for definition, value in zip(self._layout.definitions, self._values):
+            if value is not None:
+                yield definition, value
+
     @property
     def money(self):
         return self.get_stat_value("money")
-    
+
     @property
     def willpower(self):
         return self.get_stat_value("willpower")
-    
+
     @property
     def hunger(self):
         return self.get_stat_value("hunger")
-    
+
     @property
     def cleanliness(self):
         return self.get_stat_value("cleanliness")
-    
+
     @property
     def happiness(self):
-        return self.get_stat_value("happiness")
\ No newline at end of file
+        return self.get_stat_value("happiness")
+
+
+class CooldownIndex:
+    """
+    When each (user_id, action) comes off cooldown, in Unix epoch seconds, so spammed commands
+    can be turned down without reading the pet. Entries are warmed from the database the first
+    time an action is tried and moved forward after every successful one. An entry that says the
+    cooldown is over is only a hint: the caller still checks the database before acting.
+    """
+
+    __slots__ = ("_ready_at", "_prune_at", "_lock")
+
+    # Expired entries are dropped once the index grows past this many
+    MIN_PRUNE_SIZE = 10_000
+
+    def __init__(self):
+        self._ready_at: dict[tuple[int, str], float] = {}
+        self._prune_at = self.MIN_PRUNE_SIZE
+        # The cogs use it on the event loop thread, the database forgets entries from its own threads
+        self._lock = threading.Lock()
+
+    def remaining(self, user_id, action: str) -> float:
+        """Seconds until the action is known to be available again, 0 if it may be available now."""
+        ready_at = self._ready_at.get((user_id, action))
+        if ready_at is None:
+            return 0
+        return max(0, ready_at - time.time())
+
+    def record(self, user_id, action: str, ready_at: float):
+        with self._lock:
+            self._ready_at[(user_id, action)] = ready_at
+            if len(self._ready_at) >= self._prune_at:
+                self._prune()
+
+    def forget(self, user_id):
+        """Drops every entry of a user, e.g. when they hatch a new pet."""
+        with self._lock:
+            for key in [key for key in self._ready_at if key[0] == user_id]:
+                del self._ready_at[key]
+
+    def forget_stat(self, stat_name: str):
+        """Drops every entry of a stat's care action, e.g. when its cooldown changes."""
+        with self._lock:
+            for key in [key for key in self._ready_at if key[1] == stat_name]:
+                del self._ready_at[key]
+
+    def clear(self):
+        with self._lock:
+            self._ready_at = {}
+            self._prune_at = self.MIN_PRUNE_SIZE
+
+    def _prune(self):
+        # Called with the lock held. An expired entry carries no information, the database is checked either way
+        now = time.time()
+        self._ready_at = {key: ready_at for key, ready_at in self._ready_at.items() if ready_at > now}
+        self._prune_at = max(self.MIN_PRUNE_SIZE, 2 * len(self._ready_at))
+
+
+class AliasSampler:
+    """
+    Picks items at random in proportion to their weights, in constant time per pick
+    (Vose's alias method). Building it is linear in the number of items, so build it once
+    per change of the weights, not per pick.
+    """
+
+    __slots__ = ("_items", "_probabilities", "_aliases")
+
+    def __init__(self, weighted_items):
+        """'weighted_items' is an iterable of (item, weight). Items with a weight of 0 are never picked."""
+        weighted_items = [(item, weight) for item, weight in weighted_items if weight > 0]
+        if not weighted_items:
+            raise ValueError("At least one item needs a positive weight.")
+
+        count = len(weighted_items)
+        total = sum(weight for _, weight in weighted_items)
+        self._items = [item for item, _ in weighted_items]
+        self._probabilities = [1.0] * count
+        self._aliases = list(range(count))
+
+        # Scaled so the average column is exactly 1
+        scaled = [weight * count / total for _, weight in weighted_items]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            # The rest of the short column is filled from a tall one
+            self._probabilities[less] = scaled[less]
+            self._aliases[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+        # Whatever is left is 1 up to rounding errors, and keeps its defaults
+
+    def __len__(self):
+        return len(self._items)
+
+    def pick(self, rng=random):
+        column = rng.randrange(len(self._items))
+        if rng.random() < self._probabilities[column]:
+            return self._items[column]
+        return self._items[self._aliases[column]]
+
+
+# Shared by the cogs and the database module, which drops the entries its changes make stale
+cooldowns = CooldownIndex()
@@ -0,0 +1,174 @@
+# writer_service.py
+"""
+The single writer process of a cluster (see launcher.py).
+
+SQLite allows one writer at a time, so the workers send every write here over a Unix socket
+and this process runs them, in order, on its database write thread. The workers keep
+reading the database directly, from WAL snapshots. The jobs that must only run once,
+like removing the pets that ran away, also run here.
+"""
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import database
+
+# How often the writer looks for pets that ran away, like the bot's own stat_decay_loop
+RUNAWAY_CHECK_INTERVAL = 15 * 60
+# How often an idle worker asks the writer whether its caches went stale
+CACHE_SYNC_INTERVAL = 5
+
+
+def _plain(value):
+    """Turns sqlite3.Row results into dicts, the rows themselves can't be sent to another process."""
+    if isinstance(value, sqlite3.Row):
+        return dict(value)
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_plain(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    return value
+
+
+def _run_request(name, args, kwargs):
+    """Runs one write on the database write thread. Returns (result, cache versions)."""
+    if name == "get_cache_versions":
+        func = None
+    elif name == "users_hatched_since":
+        func = database.users_hatched_since
+    elif name in database.WRITE_FUNCTIONS:
+        func = database.WRITE_FUNCTIONS[name]
+    else:
+        raise ValueError(f"{name} is not a database write function.")
+
+    def run():
+        result = func(*args, **kwargs) if func else None
+        return _plain(result), database.get_cache_versions()
+
+    return database._db_write_executor.submit(run).result()
+
+
+def _serve_connection(conn):
+    """Answers one worker's requests until it disconnects."""
+    with conn:
+        while True:
+            try:
+                name, args, kwargs = conn.recv()
+            except EOFError:
+                return
+
+            try:
+                reply = ("ok", _run_request(name, args, kwargs))
+            except Exception as e:
+                reply = ("error", e)
+
+            try:
+                conn.send(reply)
+            except Exception as e:
+                # The exception itself couldn't be pickled, send its description instead
+                conn.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+def _check_runaway_pets(stop: threading.Event):
+    while not stop.wait(RUNAWAY_CHECK_INTERVAL):
+        try:
+            removed = database._db_write_executor.submit(database.remove_runaway_pets).result()
+        except Exception as e:
+            print(f"Runaway pet check failed: {e}")
+            continue
+        if removed is None:
+            print("Failed to find a valid def_if for the willpower stat. Skipping runaway pet check...")
+        else:
+            print(f"Runaway pet check has run. {len(removed)} pets ran away.")
+
+
+def serve(address: str, authkey: bytes, ready=None):
+    """
+    Sets up the database, then serves writes on the Unix socket 'address' until the process is stopped.
+    'ready' (e.g. a multiprocessing.Event) is set once workers can connect.
+    """
+    # The launcher stops the workers before the writer, so Ctrl+C must not stop it first.
+    # SIGTERM unwinds through the finally below, which lets queued writes finish.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    database.setup_database()
+
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    print(f"Database writer listening on {address}")
+    if ready is not None:
+        ready.set()
+
+    stop = threading.Event()
+    threading.Thread(
+        target=_check_runaway_pets, args=(stop,), name="pawder-runaway-check", daemon=True
+    ).start()
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # A client that failed authentication, keep serving the others
+                print(f"Rejected a database writer connection: {e}")
+                continue
+            threading.Thread(
+                target=_serve_connection, args=(conn,), name="pawder-writer-conn", daemon=True
+            ).start()
+    finally:
+        stop.set()
+        listener.close()
+        database.shutdown_db_threads()
+
+
+class RemoteWriter:
+    """
+    A worker's connection to the writer process. Only ever called from the worker's
+    database write thread, so one connection (and one request at a time) is enough.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+
+    def __call__(self, name, args, kwargs):
+        if self._conn is None:
+            self._conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        try:
+            self._conn.send((name, args, kwargs))
+            status, value = self._conn.recv()
+        except (EOFError, OSError) as e:
+            # Reconnect on the next write, the writer may have been restarted
+            self._conn.close()
+            self._conn = None
+            raise ConnectionError(f"Lost the connection to the database writer: {e}") from e
+
+        if status == "error":
+            raise value
+        return value
+
+
+def connect_to_writer(address: str, authkey: bytes):
+    """Makes this process send its writes to the writer process and keep its caches in sync with it."""
+    database.set_remote_writer(RemoteWriter(address, authkey))
+
+    def sync_periodically():
+        while True:
+            try:
+                database.sync_with_remote_writer()
+            except Exception as e:
+                print(f"Failed to sync caches with the database writer: {e}")
+            time.sleep(CACHE_SYNC_INTERVAL)
+
+    threading.Thread(
+        target=sync_periodically, name="pawder-writer-sync", daemon=True
+    ).start()